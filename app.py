@@ -1,11 +1,34 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, Response, stream_with_context, g, abort, has_request_context
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.pagination import Pagination
 from functools import wraps
+from contextlib import closing, contextmanager
+from itertools import chain, islice
+from collections import deque
 import os
+import io
+import csv
 import sys
+import tempfile
+import sqlite3
+import json
+import math
+import time
+import uuid
+import gzip
+import hashlib
+import secrets
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import create_engine, event, inspect
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.orm import joinedload
-import pandas as pd
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.dialects import sqlite, postgresql
+from datetime import date, datetime, time as dt_time, timedelta
+from types import SimpleNamespace
 
 app = Flask(__name__)
 
@@ -20,10 +43,207 @@ else:
 
 app.config['SQLALCHEMY_DATABASE_URI'] = database_url or 'sqlite:///' + os.path.join(basedir, 'gudang.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Thread request per proses (gunicorn 4, waitress 8); dipakai untuk ukuran pool DB dan antrean hash password.
+_server_threads = int(os.environ.get('GUNICORN_THREADS') or os.environ.get('WAITRESS_THREADS') or 4)
+app.config['SQLITE_BUSY_TIMEOUT_MS'] = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 10000))
+app.config['SQLITE_WAL'] = os.environ.get('SQLITE_WAL', '1') == '1'
+if app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'connect_args': {'timeout': app.config['SQLITE_BUSY_TIMEOUT_MS'] / 1000}}
+else:
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        # Satu koneksi per thread request + 2 untuk job/scheduler/sync; total = workers * (pool + overflow)
+        # harus di bawah max_connections Postgres (default 100).
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', _server_threads + 2)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 2)),
+        'pool_timeout': int(os.environ.get('DB_POOL_TIMEOUT', 30)),
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': os.environ.get('DB_POOL_PRE_PING', '1') == '1',
+    }
+    # now() disimpan ke kolom tanpa zona waktu: sesi diset UTC supaya sama dengan CURRENT_TIMESTAMP SQLite.
+    # Opsi "options" khusus libpq; driver lain harus memakai server dengan timezone UTC.
+    if make_url(app.config['SQLALCHEMY_DATABASE_URI']).get_driver_name() in ('psycopg2', 'psycopg'):
+        app.config['SQLALCHEMY_ENGINE_OPTIONS']['connect_args'] = {'options': '-c timezone=UTC'}
+# Zona jam lokal server Postgres sebelum sesi diset UTC (mis. Asia/Jakarta); lihat README, bagian upgrade.
+app.config['DB_LEGACY_TIMEZONE'] = os.environ.get('DB_LEGACY_TIMEZONE')
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'kunci-rahasia-lokal-yang-super-aman')
+app.config['IMPORT_CHUNK_ROWS'] = int(os.environ.get('IMPORT_CHUNK_ROWS', 5000))
+app.config['IMPORT_STREAMING_BYTES'] = int(os.environ.get('IMPORT_STREAMING_BYTES', 20 * 1024 * 1024))
+app.config['SEARCH_MIN_SIMILARITY'] = float(os.environ.get('SEARCH_MIN_SIMILARITY', 0.5))
+app.config['DASHBOARD_CACHE_TTL'] = int(os.environ.get('DASHBOARD_CACHE_TTL', 60))
+app.config['PERMISSION_CACHE_TTL'] = int(os.environ.get('PERMISSION_CACHE_TTL', 300))
+app.config['SNAPSHOT_INTERVAL'] = int(os.environ.get('SNAPSHOT_INTERVAL', 3600))
+app.config['SLOW_REQUEST_MS'] = float(os.environ.get('SLOW_REQUEST_MS', 500))
+app.config['SLOW_QUERY_MS'] = float(os.environ.get('SLOW_QUERY_MS', 100))
+app.config['METRICS_WINDOW'] = int(os.environ.get('METRICS_WINDOW', 1000))
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+# Direktori bersama untuk agregasi metrik antar worker gunicorn (diisi otomatis oleh gunicorn.conf.py).
+app.config['METRICS_DIR'] = os.environ.get('METRICS_DIR')
+app.config['METRICS_FLUSH_INTERVAL'] = float(os.environ.get('METRICS_FLUSH_INTERVAL', 5))
+app.config['JOB_WORKERS'] = int(os.environ.get('JOB_WORKERS', 1))
+app.config['JOB_UPLOAD_DIR'] = os.environ.get('JOB_UPLOAD_DIR', os.path.join(basedir, 'uploads'))
+# Contoh: pbkdf2:sha256:260000 atau scrypt:32768:8:1. Hash lama diperbarui otomatis saat user login.
+app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD', 'pbkdf2:sha256')
+app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get('PASSWORD_HASH_WORKERS', 2))
+# Request yang menunggu hash memegang thread server-nya, jadi antrean harus lebih kecil dari jumlah
+# thread (gunicorn 4, waitress 8) supaya burst login tidak memarkir semua thread sebelum ada 503.
+app.config['PASSWORD_HASH_QUEUE'] = int(os.environ.get('PASSWORD_HASH_QUEUE', max(_server_threads // 2, 1)))
+# Batas gagal login per IP+username; batas per IP jauh lebih longgar karena di desktop semua klien
+# tampil sebagai 127.0.0.1 dan di server satu shift bisa berbagi satu NAT.
+app.config['LOGIN_MAX_ATTEMPTS'] = int(os.environ.get('LOGIN_MAX_ATTEMPTS', 10))
+app.config['LOGIN_MAX_ATTEMPTS_PER_IP'] = int(os.environ.get('LOGIN_MAX_ATTEMPTS_PER_IP', 200))
+app.config['LOGIN_WINDOW'] = int(os.environ.get('LOGIN_WINDOW', 300))
+app.config['ARCHIVE_DIR'] = os.environ.get('ARCHIVE_DIR', os.path.join(basedir, 'archive'))
+# 0 = arsip otomatis nonaktif; arsip tetap bisa dijalankan manual dari halaman riwayat.
+app.config['ARCHIVE_AFTER_DAYS'] = int(os.environ.get('ARCHIVE_AFTER_DAYS', 0))
+# Mode cabang: SYNC_REMOTE_URL (database pusat) + SYNC_KANTOR (kode_kantor cabang ini).
+# Server pusat mengaktifkan SYNC_RECORD_CHANGES supaya perubahan data master tercatat untuk cabang.
+app.config['SYNC_REMOTE_URL'] = os.environ.get('SYNC_REMOTE_URL')
+app.config['SYNC_KANTOR'] = os.environ.get('SYNC_KANTOR')
+app.config['SYNC_RECORD_CHANGES'] = os.environ.get('SYNC_RECORD_CHANGES', '0') == '1'
+app.config['SYNC_INTERVAL'] = int(os.environ.get('SYNC_INTERVAL', 30))
+app.config['SYNC_BATCH'] = int(os.environ.get('SYNC_BATCH', 200))
+# Pusat: SyncChange yang sudah dikonfirmasi semua cabang dipangkas; yang lebih tua dari N hari dipangkas
+# walau ada cabang yang belum menariknya (cabang itu mengambil ulang salinan penuh). 0 = tanpa batas umur.
+app.config['SYNC_CHANGE_RETENTION_DAYS'] = int(os.environ.get('SYNC_CHANGE_RETENTION_DAYS', 30))
 
 db = SQLAlchemy(app)
 
+@event.listens_for(Engine, 'connect')
+def _configure_sqlite_connection(dbapi_connection, connection_record):
+    # WAL: pembaca tidak menunggu penulis (job impor, sync) dan sebaliknya.
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA busy_timeout = {app.config['SQLITE_BUSY_TIMEOUT_MS']}")
+    if app.config['SQLITE_WAL']:
+        cursor.execute('PRAGMA journal_mode = WAL')
+        cursor.execute('PRAGMA synchronous = NORMAL')
+    cursor.close()
+
+# --- Instrumentasi Performa ---
+# Setiap request mencatat latensi, jumlah statement SQL dan total waktu DB. Agregat per endpoint
+# (jendela METRICS_WINDOW sampel terakhir) ditampilkan di /admin/metrics dan /metrics.
+# Dengan METRICS_DIR, setiap worker menulis agregatnya ke satu file di direktori itu paling lama tiap
+# METRICS_FLUSH_INTERVAL detik, dan ringkasan menjumlahkan semua file: counter tidak mundur saat scrape
+# berpindah worker, dan p50/p95 dihitung dari sampel semua worker.
+_metrics_lock = threading.Lock()
+_endpoint_metrics = {}
+_metrics_flushed = 0.0
+_metrics_files = {}
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # Disimpan di context (satu per eksekusi), bukan stack di conn.info: query yang gagal tidak
+    # memanggil after_cursor_execute dan tidak meninggalkan sisa.
+    context.minty_query_started = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - context.minty_query_started
+    if has_request_context() and 'perf' in g:
+        g.perf['queries'] += 1
+        g.perf['db_time'] += elapsed
+    if elapsed * 1000 >= app.config['SLOW_QUERY_MS']:
+        app.logger.warning('Query lambat (%.1f ms): %s', elapsed * 1000, ' '.join(statement.split())[:500])
+
+@app.before_request
+def _start_request_timer():
+    g.perf = {'started': time.perf_counter(), 'queries': 0, 'db_time': 0.0}
+
+@app.after_request
+def _record_request_metrics(response):
+    global _metrics_flushed
+    perf = g.pop('perf', None)
+    if perf is None:
+        return response
+    elapsed = time.perf_counter() - perf['started']
+    endpoint = request.endpoint or 'not_found'
+    with _metrics_lock:
+        metrics = _endpoint_metrics.get(endpoint)
+        if metrics is None:
+            metrics = _endpoint_metrics[endpoint] = {'count': 0, 'errors': 0, 'total_time': 0.0, 'queries': 0, 'db_time': 0.0,
+                                                     'latencies': deque(maxlen=app.config['METRICS_WINDOW'])}
+        metrics['count'] += 1
+        metrics['errors'] += response.status_code >= 500
+        metrics['total_time'] += elapsed
+        metrics['queries'] += perf['queries']
+        metrics['db_time'] += perf['db_time']
+        metrics['latencies'].append(elapsed)
+        flush_due = app.config['METRICS_DIR'] and time.monotonic() - _metrics_flushed >= app.config['METRICS_FLUSH_INTERVAL']
+        if flush_due:
+            _metrics_flushed = time.monotonic()
+    if flush_due:
+        flush_metrics()
+    if elapsed * 1000 >= app.config['SLOW_REQUEST_MS']:
+        app.logger.warning('Request lambat %s %s: %.1f ms, %d query SQL, %.1f ms di DB', request.method, request.full_path,
+                           elapsed * 1000, perf['queries'], perf['db_time'] * 1000)
+    return response
+
+def _percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(math.ceil(percent / 100 * len(sorted_values)) - 1, 0)]
+
+def _metrics_file():
+    # Nama file unik per proses (bukan hanya pid): worker baru yang kebetulan mendapat pid worker lama
+    # tidak menimpa counter yang sudah tercatat.
+    pid = os.getpid()
+    if pid not in _metrics_files:
+        _metrics_files[pid] = os.path.join(app.config['METRICS_DIR'], f'{pid}-{uuid.uuid4().hex}.json')
+    return _metrics_files[pid]
+
+def _local_metrics(retire=False):
+    with _metrics_lock:
+        return {endpoint: dict(metrics, latencies=[] if retire else list(metrics['latencies']))
+                for endpoint, metrics in _endpoint_metrics.items()}
+
+def flush_metrics(retire=False):
+    # retire=True dipanggil saat worker berhenti: counter tetap dijumlahkan, sampel latensinya tidak.
+    if not app.config['METRICS_DIR']:
+        return
+    path = _metrics_file()
+    temp_path = f'{path}.{threading.get_ident()}.tmp'
+    try:
+        with open(temp_path, 'w') as fh:
+            json.dump(_local_metrics(retire), fh)
+        os.replace(temp_path, path)
+    except OSError:
+        app.logger.exception('Gagal menulis metrik ke %s', path)
+
+def _collected_metrics():
+    sources = [_local_metrics()]
+    metrics_dir = app.config['METRICS_DIR']
+    if metrics_dir:
+        own_file = os.path.basename(_metrics_file())
+        try:
+            names = [name for name in os.listdir(metrics_dir) if name.endswith('.json') and name != own_file]
+        except OSError:
+            names = []
+        for name in names:
+            try:
+                with open(os.path.join(metrics_dir, name)) as fh:
+                    sources.append(json.load(fh))
+            except (OSError, ValueError):
+                continue
+    merged = {}
+    for source in sources:
+        for endpoint, metrics in source.items():
+            total = merged.setdefault(endpoint, {'count': 0, 'errors': 0, 'total_time': 0.0, 'queries': 0, 'db_time': 0.0, 'latencies': []})
+            for key in ('count', 'errors', 'total_time', 'queries', 'db_time'):
+                total[key] += metrics[key]
+            total['latencies'] += metrics['latencies']
+    return merged
+
+def metrics_summary():
+    summary = []
+    for endpoint, metrics in sorted(_collected_metrics().items()):
+        latencies = sorted(metrics['latencies'])
+        summary.append({'endpoint': endpoint, 'count': metrics['count'], 'errors': metrics['errors'],
+                        'total_time': metrics['total_time'], 'queries': metrics['queries'], 'db_time': metrics['db_time'],
+                        'p50': _percentile(latencies, 50), 'p95': _percentile(latencies, 95), 'max': latencies[-1] if latencies else 0.0,
+                        'avg_queries': metrics['queries'] / metrics['count'], 'avg_db_time': metrics['db_time'] / metrics['count']})
+    return summary
+
 # --- Model Database (Tidak ada perubahan) ---
 user_material_permissions = db.Table('user_material_permissions',
     db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
@@ -34,6 +254,7 @@ class Kantor(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     nama_kantor = db.Column(db.String(100), unique=True, nullable=False)
     kode_kantor = db.Column(db.String(20), unique=True, nullable=False)
+    low_stock_threshold = db.Column(db.Integer, nullable=False, default=50, server_default='50')
     users = db.relationship('User', backref='kantor', lazy=True)
     materials = db.relationship('Material', backref='kantor', lazy=True)
     transactions = db.relationship('Transaction', backref='kantor', lazy=True)
@@ -44,7 +265,9 @@ class User(db.Model):
     password = db.Column(db.String(256), nullable=False)
     role = db.Column(db.String(20), nullable=False, default='user')
     kantor_id = db.Column(db.Integer, db.ForeignKey('kantor.id'), nullable=False)
-    permitted_materials = db.relationship('Material', secondary=user_material_permissions, lazy='subquery',
+    # Dinaikkan setiap izin material berubah; cache izin di worker lain membandingkannya.
+    izin_versi = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    permitted_materials = db.relationship('Material', secondary=user_material_permissions, lazy='select',
         backref=db.backref('permitted_users', lazy=True))
 
 class Satuan(db.Model):
@@ -59,8 +282,13 @@ class Material(db.Model):
     jumlah = db.Column(db.Integer, nullable=False)
     kantor_id = db.Column(db.Integer, db.ForeignKey('kantor.id'), nullable=False)
     satuan_id = db.Column(db.Integer, db.ForeignKey('satuan.id'), nullable=False)
+    stok_minimum = db.Column(db.Integer, nullable=True)
     __table_args__ = (db.UniqueConstraint('id_barang', 'kantor_id', name='_id_barang_kantor_uc'),)
 
+# CURRENT_TIMESTAMP di SQLite disimpan tanpa mikrodetik; bind parameter harus memakai format
+# yang sama supaya perbandingan timestamp (keyset pagination) tidak meleset.
+SQLITE_TIMESTAMP = sqlite.DATETIME(storage_format='%(year)04d-%(month)02d-%(day)02d %(hour)02d:%(minute)02d:%(second)02d')
+
 class Transaction(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     material_id = db.Column(db.Integer, db.ForeignKey('material.id'), nullable=False)
@@ -68,10 +296,299 @@ class Transaction(db.Model):
     jumlah = db.Column(db.Integer, nullable=False)
     sumber = db.Column(db.String(100), nullable=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    timestamp = db.Column(db.DateTime, server_default=db.func.now())
+    timestamp = db.Column(db.DateTime().with_variant(SQLITE_TIMESTAMP, 'sqlite'), server_default=db.func.now())
     kantor_id = db.Column(db.Integer, db.ForeignKey('kantor.id'), nullable=False)
     user = db.relationship('User', backref=db.backref('transactions', lazy=True))
     material = db.relationship('Material', backref=db.backref('transactions', lazy=True))
+    __table_args__ = (db.Index('ix_transaction_kantor_timestamp_id', 'kantor_id', 'timestamp', 'id'),
+                      db.Index('ix_transaction_material_timestamp', 'material_id', 'timestamp'))
+
+class StockSnapshot(db.Model):
+    # Stok penutupan (akhir hari) per material, hanya untuk hari yang punya transaksi.
+    id = db.Column(db.Integer, primary_key=True)
+    material_id = db.Column(db.Integer, db.ForeignKey('material.id'), nullable=False)
+    kantor_id = db.Column(db.Integer, db.ForeignKey('kantor.id'), nullable=False)
+    tanggal = db.Column(db.Date, nullable=False)
+    jumlah = db.Column(db.Integer, nullable=False)
+    __table_args__ = (db.UniqueConstraint('material_id', 'tanggal', name='_snapshot_material_tanggal_uc'),
+                      db.Index('ix_stock_snapshot_kantor_tanggal', 'kantor_id', 'tanggal'))
+
+class DailyRollup(db.Model):
+    # Total IN/OUT harian per material untuk laporan; hanya hari yang sudah lengkap.
+    id = db.Column(db.Integer, primary_key=True)
+    material_id = db.Column(db.Integer, db.ForeignKey('material.id'), nullable=False)
+    kantor_id = db.Column(db.Integer, db.ForeignKey('kantor.id'), nullable=False)
+    tanggal = db.Column(db.Date, nullable=False)
+    qty_in = db.Column(db.Integer, nullable=False, default=0)
+    qty_out = db.Column(db.Integer, nullable=False, default=0)
+    n_transaksi = db.Column(db.Integer, nullable=False, default=0)
+    __table_args__ = (db.UniqueConstraint('material_id', 'tanggal', name='_rollup_material_tanggal_uc'),
+                      db.Index('ix_daily_rollup_kantor_tanggal', 'kantor_id', 'tanggal'),
+                      db.Index('ix_daily_rollup_tanggal_material', 'tanggal', 'material_id'))
+
+class Job(db.Model):
+    id = db.Column(db.String(32), primary_key=True)
+    jenis = db.Column(db.String(50), nullable=False)
+    status = db.Column(db.String(10), nullable=False, default='queued')
+    progress = db.Column(db.Integer, nullable=False, default=0)
+    pesan = db.Column(db.String(500), nullable=True)
+    params = db.Column(db.Text, nullable=False, default='{}')
+    hasil = db.Column(db.Text, nullable=True)
+    kantor_id = db.Column(db.Integer, db.ForeignKey('kantor.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    created_at = db.Column(db.DateTime, server_default=db.func.now())
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+class ApiToken(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    nama = db.Column(db.String(100), nullable=False)
+    token_hash = db.Column(db.String(64), unique=True, nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    created_at = db.Column(db.DateTime, server_default=db.func.now())
+    user = db.relationship('User', backref=db.backref('api_tokens', lazy=True))
+
+class ArchiveSegment(db.Model):
+    # Katalog file arsip riwayat: satu file SQLite per kantor per tahun.
+    id = db.Column(db.Integer, primary_key=True)
+    kantor_id = db.Column(db.Integer, db.ForeignKey('kantor.id'), nullable=False)
+    tahun = db.Column(db.Integer, nullable=False)
+    nama_file = db.Column(db.String(200), nullable=False)
+    jumlah_baris = db.Column(db.Integer, nullable=False, default=0)
+    ts_min = db.Column(db.DateTime, nullable=True)
+    ts_max = db.Column(db.DateTime, nullable=True)
+    __table_args__ = (db.UniqueConstraint('kantor_id', 'tahun', name='_archive_kantor_tahun_uc'),)
+
+class SyncOutbox(db.Model):
+    # Cabang: pergerakan stok yang sudah di-commit lokal tapi belum diterapkan di pusat.
+    id = db.Column(db.Integer, primary_key=True)
+    uuid = db.Column(db.String(32), unique=True, nullable=False)
+    jenis = db.Column(db.String(20), nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    # pending -> sent, atau conflict bila ada baris yang ditolak pusat; conflict -> resolved oleh admin.
+    status = db.Column(db.String(10), nullable=False, default='pending')
+    pesan = db.Column(db.String(500), nullable=True)
+    ditolak = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, server_default=db.func.now())
+    sent_at = db.Column(db.DateTime, nullable=True)
+    __table_args__ = (db.Index('ix_sync_outbox_status_id', 'status', 'id'),)
+
+class SyncReceipt(db.Model):
+    # Pusat: uuid kiriman cabang yang sudah diproses, supaya kiriman ulang tidak diterapkan dua kali.
+    uuid = db.Column(db.String(32), primary_key=True)
+    status = db.Column(db.String(10), nullable=False)
+    pesan = db.Column(db.String(500), nullable=True)
+    ditolak = db.Column(db.Text, nullable=True)
+    received_at = db.Column(db.DateTime, server_default=db.func.now())
+
+class SyncChange(db.Model):
+    # Pusat: log perubahan data master; cabang menarik baris dengan seq > seq terakhir yang dilihatnya.
+    seq = db.Column(db.Integer, primary_key=True)
+    entitas = db.Column(db.String(20), nullable=False)
+    entitas_id = db.Column(db.Integer, nullable=False)
+    kantor_id = db.Column(db.Integer, nullable=True)
+    created_at = db.Column(db.DateTime, server_default=db.func.now())
+
+class SyncState(db.Model):
+    nama = db.Column(db.String(50), primary_key=True)
+    nilai = db.Column(db.String(100), nullable=False)
+
+def _add_missing_columns(table):
+    existing = {column['name'] for column in inspect(db.engine).get_columns(table.name)}
+    preparer = db.engine.dialect.identifier_preparer
+    with db.engine.begin() as connection:
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            ddl = f'ALTER TABLE {preparer.format_table(table)} ADD COLUMN {preparer.format_column(column)} {column.type.compile(db.engine.dialect)}'
+            if column.server_default is not None:
+                ddl += f' DEFAULT {column.server_default.arg}'
+            connection.exec_driver_sql(ddl)
+
+def upgrade_schema():
+    # create_all() tidak menambahkan kolom/index baru ke tabel yang sudah ada di database lama.
+    with app.app_context():
+        db.create_all()
+        for table in (Kantor.__table__, Material.__table__, User.__table__, SyncOutbox.__table__, SyncReceipt.__table__):
+            _add_missing_columns(table)
+        for index in Transaction.__table__.indexes:
+            index.create(db.engine, checkfirst=True)
+        _setup_search_index()
+        _convert_legacy_timestamps()
+
+def _convert_legacy_timestamps():
+    # Sebelum sesi Postgres diset UTC, now() menulis jam lokal server ke transaction.timestamp. Batas id
+    # dicatat saat upgrade pertama; baris sampai batas itu dikonversi sekali setelah DB_LEGACY_TIMEZONE diisi.
+    if db.engine.dialect.name != 'postgresql':
+        return
+    boundary = _sync_state('timestamp_legacy_max_id')
+    if boundary is None:
+        boundary = db.session.query(db.func.coalesce(db.func.max(Transaction.id), 0)).scalar()
+        _set_sync_state('timestamp_legacy_max_id', boundary)
+        if not boundary:
+            _set_sync_state('timestamp_utc_converted', 'UTC')
+        db.session.commit()
+    if _sync_state('timestamp_utc_converted') is not None:
+        return
+    zone = app.config['DB_LEGACY_TIMEZONE']
+    if not zone:
+        app.logger.warning('Timestamp transaksi lama (id <= %s) masih jam lokal server; isi DB_LEGACY_TIMEZONE untuk mengonversinya ke UTC.', boundary)
+        return
+    table = Transaction.__table__
+    db.session.execute(table.update().where(table.c.id <= int(boundary))
+                       .values(timestamp=db.func.timezone('UTC', db.func.timezone(zone, table.c.timestamp))))
+    _set_sync_state('timestamp_utc_converted', zone)
+    db.session.commit()
+
+# --- Indeks Pencarian Material ---
+# SQLite: tabel FTS5 (tokenizer trigram bila tersedia) yang disinkronkan lewat trigger, sehingga
+# insert massal dari impor juga ikut terindeks. Postgres: index GIN pg_trgm. Bila keduanya tidak
+# tersedia, pencarian kembali ke ILIKE biasa.
+SQLITE_SEARCH_TRIGGERS = [
+    """CREATE TRIGGER IF NOT EXISTS material_fts_ai AFTER INSERT ON material BEGIN
+        INSERT INTO material_fts(rowid, nama_material, id_barang) VALUES (new.id, new.nama_material, new.id_barang);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS material_fts_ad AFTER DELETE ON material BEGIN
+        INSERT INTO material_fts(material_fts, rowid, nama_material, id_barang) VALUES ('delete', old.id, old.nama_material, old.id_barang);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS material_fts_au AFTER UPDATE OF nama_material, id_barang ON material BEGIN
+        INSERT INTO material_fts(material_fts, rowid, nama_material, id_barang) VALUES ('delete', old.id, old.nama_material, old.id_barang);
+        INSERT INTO material_fts(rowid, nama_material, id_barang) VALUES (new.id, new.nama_material, new.id_barang);
+    END""",
+]
+POSTGRES_SEARCH_DDL = [
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    'CREATE INDEX IF NOT EXISTS ix_material_nama_trgm ON material USING gin (nama_material gin_trgm_ops)',
+    'CREATE INDEX IF NOT EXISTS ix_material_id_barang_trgm ON material USING gin (id_barang gin_trgm_ops)',
+]
+_search_backend = None
+
+def _setup_search_index():
+    global _search_backend
+    _search_backend = None
+    try:
+        if db.engine.dialect.name == 'sqlite':
+            with db.engine.begin() as connection:
+                if not connection.exec_driver_sql("SELECT 1 FROM sqlite_master WHERE name = 'material_fts'").scalar():
+                    version = tuple(int(part) for part in sqlite3.sqlite_version.split('.'))
+                    tokenize = 'trigram' if version >= (3, 34, 0) else 'unicode61'
+                    connection.exec_driver_sql("CREATE VIRTUAL TABLE material_fts USING fts5(nama_material, id_barang, "
+                                               f"content='material', content_rowid='id', tokenize='{tokenize}')")
+                    connection.exec_driver_sql("INSERT INTO material_fts(material_fts) VALUES ('rebuild')")
+                for trigger in SQLITE_SEARCH_TRIGGERS:
+                    connection.exec_driver_sql(trigger)
+        elif db.engine.dialect.name == 'postgresql':
+            for ddl in POSTGRES_SEARCH_DDL:
+                with db.engine.begin() as connection:
+                    connection.exec_driver_sql(ddl)
+    except DBAPIError:
+        app.logger.warning('Indeks pencarian tidak bisa dibuat, pencarian memakai ILIKE.', exc_info=True)
+
+def _get_search_backend():
+    global _search_backend
+    if _search_backend is None:
+        backend = 'like'
+        if db.engine.dialect.name == 'sqlite':
+            ddl = db.session.execute(db.text("SELECT sql FROM sqlite_master WHERE name = 'material_fts'")).scalar()
+            if ddl:
+                backend = 'fts5_trigram' if 'trigram' in ddl else 'fts5'
+        elif db.engine.dialect.name == 'postgresql':
+            if db.session.execute(db.text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")).scalar():
+                backend = 'pg_trgm'
+        _search_backend = backend
+    return _search_backend
+
+def _trigrams(text):
+    grams = set()
+    for word in text.lower().split():
+        padded = f'  {word} '
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+def _similarity(query_grams, text):
+    # Porsi trigram query yang muncul di teks (mirip word_similarity milik pg_trgm).
+    return len(query_grams & _trigrams(text)) / len(query_grams) if query_grams else 0.0
+
+def _fts_phrase(token):
+    return '"' + token.replace('"', '""') + '"'
+
+def _escape_like(term):
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def search_material_ids(kantor_id, search_query, limit=None, permitted_user_id=None):
+    # Mengembalikan id material yang cocok, diurutkan dari yang paling relevan; limit=None berarti semua.
+    # permitted_user_id: hanya material yang diizinkan untuk user tersebut, disaring sebelum LIMIT.
+    tokens = search_query.lower().split()
+    if not tokens:
+        return []
+    permitted = ('AND {id} IN (SELECT material_id FROM user_material_permissions WHERE user_id = :user_id) '
+                 if permitted_user_id is not None else '')
+    sql_limit = limit if limit is not None else (-1 if db.engine.dialect.name == 'sqlite' else None)
+    like = f"%{_escape_like(search_query.strip())}%"
+    backend = _get_search_backend()
+    if backend == 'pg_trgm':
+        rows = db.session.execute(db.text(
+            "SELECT id FROM material WHERE kantor_id = :kantor_id AND ("
+            "nama_material ILIKE :like ESCAPE '\\' OR id_barang ILIKE :like ESCAPE '\\' "
+            "OR :q <% nama_material OR :q <% id_barang) " + permitted.format(id='id') +
+            "ORDER BY (nama_material ILIKE :like ESCAPE '\\' OR id_barang ILIKE :like ESCAPE '\\') DESC, "
+            "greatest(word_similarity(:q, nama_material), word_similarity(:q, id_barang)) DESC, nama_material "
+            "LIMIT :limit"), {'kantor_id': kantor_id, 'like': like, 'q': search_query, 'limit': sql_limit, 'user_id': permitted_user_id})
+        return [row.id for row in rows]
+    if backend == 'like' or (backend == 'fts5_trigram' and all(len(token) < 3 for token in tokens)):
+        # Trigram butuh minimal 3 karakter; query yang sangat pendek memakai LIKE.
+        query = (db.session.query(Material.id).filter(Material.kantor_id == kantor_id)
+                 .filter(db.or_(Material.nama_material.ilike(like, escape='\\'), Material.id_barang.ilike(like, escape='\\'))))
+        if permitted_user_id is not None:
+            query = query.filter(Material.id.in_(db.select(user_material_permissions.c.material_id)
+                                                 .where(user_material_permissions.c.user_id == permitted_user_id)))
+        return [row.id for row in query.order_by(Material.nama_material).limit(limit)]
+    if backend == 'fts5':
+        match = ' AND '.join(_fts_phrase(token) + '*' for token in tokens)
+    else:
+        # OR atas semua trigram query: kandidat yang mirip (salah ketik, urutan kata beda) ikut
+        # terambil, lalu disaring dengan skor kemiripan di bawah.
+        grams = {token[i:i + 3] for token in tokens for i in range(len(token) - 2)}
+        match = ' OR '.join(_fts_phrase(gram) for gram in sorted(grams))
+    rows = db.session.execute(db.text(
+        "SELECT m.id, m.nama_material, m.id_barang FROM material_fts JOIN material m ON m.id = material_fts.rowid "
+        "WHERE material_fts MATCH :match AND m.kantor_id = :kantor_id " + permitted.format(id='m.id') + "ORDER BY bm25(material_fts) LIMIT :limit"),
+        {'match': match, 'kantor_id': kantor_id, 'limit': limit * 4 if limit is not None and backend == 'fts5_trigram' else sql_limit,
+         'user_id': permitted_user_id}).all()
+    if backend == 'fts5':
+        return [row.id for row in rows]
+    needle = search_query.strip().lower()
+    query_grams = _trigrams(search_query)
+    scored = []
+    for rank, row in enumerate(rows):
+        exact = needle in row.nama_material.lower() or needle in row.id_barang.lower()
+        score = max(_similarity(query_grams, row.nama_material), _similarity(query_grams, row.id_barang))
+        if exact or score >= app.config['SEARCH_MIN_SIMILARITY']:
+            scored.append((not exact, -score, rank, row.id))
+    return [item[-1] for item in sorted(scored)[:limit]]
+
+# --- Status Startup ---
+# pandas/openpyxl sengaja diimpor di dalam fungsi impor/ekspor supaya tidak memperlambat startup.
+_startup_marks = {}
+_app_ready = threading.Event()
+
+def mark_startup(name, at=None):
+    _startup_marks[name] = at if at is not None else time.perf_counter()
+
+def mark_ready():
+    mark_startup('app_ready')
+    _app_ready.set()
+
+def startup_report():
+    if not _startup_marks:
+        return {}
+    origin = min(_startup_marks.values())
+    return {name: round(at - origin, 3) for name, at in sorted(_startup_marks.items(), key=lambda item: item[1])}
+
+@app.route('/health')
+def health():
+    if not _app_ready.is_set():
+        return jsonify({'status': 'starting'}), 503
+    return jsonify({'status': 'ok', 'startup': startup_report()})
 
 # --- Rute Aplikasi (Tidak ada perubahan signifikan) ---
 # ... (Semua @app.route kamu tetap sama di sini) ...
@@ -79,43 +596,266 @@ class Transaction(db.Model):
 def home():
     return redirect(url_for('login'))
 
+# --- Autentikasi ---
+# Hash password sengaja mahal. Pengecekan dijalankan di pool kecil supaya login serentak satu shift
+# tidak menghabiskan CPU untuk request lain, dan antrean yang penuh ditolak daripada menumpuk.
+LOGIN_TRACK_MAX = 10000
+_password_executor = None
+_password_slots = None
+_password_executor_lock = threading.Lock()
+_password_methods = {}
+_password_methods_lock = threading.Lock()
+_login_failures = {}
+_login_lock = threading.Lock()
+
+class PasswordBusyError(Exception):
+    pass
+
+def _run_password_task(fn, *args):
+    global _password_executor, _password_slots
+    with _password_executor_lock:
+        if _password_executor is None:
+            _password_executor = ThreadPoolExecutor(max_workers=app.config['PASSWORD_HASH_WORKERS'], thread_name_prefix='minty-password')
+            _password_slots = threading.BoundedSemaphore(app.config['PASSWORD_HASH_QUEUE'])
+    if not _password_slots.acquire(blocking=False):
+        raise PasswordBusyError()
+    try:
+        return _password_executor.submit(fn, *args).result()
+    finally:
+        _password_slots.release()
+
+def password_hash_method():
+    # Bentuk lengkap metode termasuk parameter default werkzeug, misal "pbkdf2:sha256:600000".
+    method = app.config['PASSWORD_HASH_METHOD']
+    # Dihitung sekali per proses, di dalam pool: login pertama yang serentak tidak masing-masing
+    # membayar satu hash penuh di thread request. PasswordBusyError diteruskan ke pemanggil.
+    if method not in _password_methods:
+        with _password_methods_lock:
+            if method not in _password_methods:
+                _password_methods[method] = _run_password_task(generate_password_hash, '', method).split('$', 1)[0]
+    return _password_methods[method]
+
+def hash_password(password):
+    return _run_password_task(generate_password_hash, password, app.config['PASSWORD_HASH_METHOD'])
+
+def _login_limit_keys(username):
+    # {key: batas}. Gagal login untuk satu username tidak mengunci user lain di balik IP yang sama.
+    ip = request.remote_addr
+    return {f'user:{ip}:{username.lower()}': app.config['LOGIN_MAX_ATTEMPTS'], f'ip:{ip}': app.config['LOGIN_MAX_ATTEMPTS_PER_IP']}
+
+def _login_blocked(keys):
+    cutoff = time.monotonic() - app.config['LOGIN_WINDOW']
+    with _login_lock:
+        for key, limit in keys.items():
+            attempts = _login_failures.get(key)
+            while attempts and attempts[0] < cutoff:
+                attempts.popleft()
+            if attempts and len(attempts) >= limit:
+                return True
+    return False
+
+def _record_login_failure(keys):
+    now = time.monotonic()
+    with _login_lock:
+        if len(_login_failures) >= LOGIN_TRACK_MAX:
+            cutoff = now - app.config['LOGIN_WINDOW']
+            for key in [key for key, attempts in _login_failures.items() if not attempts or attempts[-1] < cutoff]:
+                del _login_failures[key]
+        for key, limit in keys.items():
+            _login_failures.setdefault(key, deque(maxlen=limit)).append(now)
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
-        user = User.query.filter_by(username=username).first()
-        if user and check_password_hash(user.password, password):
+        limit_keys = _login_limit_keys(username)
+        if _login_blocked(limit_keys):
+            flash(f"Terlalu banyak percobaan login. Coba lagi dalam {max(app.config['LOGIN_WINDOW'] // 60, 1)} menit.", 'danger')
+            return render_template('login.html'), 429
+        row = db.session.query(User, Kantor.nama_kantor).join(Kantor, User.kantor_id == Kantor.id).filter(User.username == username).first()
+        try:
+            valid = row is not None and _run_password_task(check_password_hash, row[0].password, password)
+        except PasswordBusyError:
+            flash('Server sedang sibuk, silakan coba login lagi sebentar.', 'warning')
+            return render_template('login.html'), 503
+        if valid:
+            user, nama_kantor = row
+            try:
+                if not user.password.startswith(password_hash_method() + '$'):
+                    # Parameter hash berubah sejak password ini disimpan: perbarui selagi password asli tersedia.
+                    user.password = hash_password(password)
+                    record_sync_changes('user', [user.id], user.kantor_id)
+                    db.session.commit()
+            except PasswordBusyError:
+                pass
+            with _login_lock:
+                _login_failures.pop(next(iter(limit_keys)), None)
             session['user_id'] = user.id
             session['username'] = user.username
             session['role'] = user.role
             session['kantor_id'] = user.kantor_id
-            kantor = Kantor.query.get(user.kantor_id)
-            session['nama_kantor'] = kantor.nama_kantor
+            session['nama_kantor'] = nama_kantor
             flash('Login berhasil!', 'success')
             return redirect(url_for('dashboard'))
         else:
+            _record_login_failure(limit_keys)
             flash('Username atau Password salah.', 'danger')
             return redirect(url_for('login'))
     return render_template('login.html')
 
+# --- Cache Dashboard ---
+class _TTLCache:
+    def __init__(self, ttl_config_key):
+        self.ttl_config_key = ttl_config_key
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                return None
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + app.config[self.ttl_config_key], value)
+
+    def update(self, key, apply):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] >= time.monotonic():
+                apply(entry[1])
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+# Agregat dashboard per kantor. Jalur yang mengubah stok memperbarui cache secara inkremental
+# setelah commit; perubahan massal (impor, hapus riwayat, ubah threshold) cukup meng-invalidate.
+# TTL menjadi jaring pengaman untuk perubahan dari proses/worker lain.
+_dashboard_cache = _TTLCache('DASHBOARD_CACHE_TTL')
+
+def _material_snapshot(material):
+    return SimpleNamespace(id=material.id, id_barang=material.id_barang, nama_material=material.nama_material,
+                           jumlah=material.jumlah, stok_minimum=material.stok_minimum,
+                           satuan=SimpleNamespace(nama=material.satuan.nama))
+
+def _transaction_snapshot(transaction):
+    if transaction is None:
+        return None
+    return SimpleNamespace(id=transaction.id, tipe_transaksi=transaction.tipe_transaksi, jumlah=transaction.jumlah,
+                           sumber=transaction.sumber, timestamp=transaction.timestamp,
+                           material=SimpleNamespace(id=transaction.material.id, id_barang=transaction.material.id_barang,
+                                                    nama_material=transaction.material.nama_material),
+                           user=SimpleNamespace(username=transaction.user.username))
+
+def _load_latest_transaction(kantor_id):
+    return _transaction_snapshot(Transaction.query.options(joinedload(Transaction.material), joinedload(Transaction.user))
+                                 .filter_by(kantor_id=kantor_id).order_by(Transaction.timestamp.desc(), Transaction.id.desc()).first())
+
+def _load_dashboard_stats(kantor_id):
+    threshold = db.session.query(Kantor.low_stock_threshold).filter_by(id=kantor_id).scalar() or 0
+    total_material_types, total_stock = (db.session.query(db.func.count(Material.id), db.func.coalesce(db.func.sum(Material.jumlah), 0))
+                                         .filter(Material.kantor_id == kantor_id).one())
+    low_stock = (Material.query.options(joinedload(Material.satuan))
+                 .filter(Material.kantor_id == kantor_id, Material.jumlah < db.func.coalesce(Material.stok_minimum, threshold)).all())
+    return {'threshold': threshold, 'total_material_types': total_material_types, 'total_stock': total_stock,
+            'latest_transaction': _load_latest_transaction(kantor_id),
+            'low_stock': {material.id: _material_snapshot(material) for material in low_stock}}
+
+def dashboard_stats(kantor_id):
+    stats = _dashboard_cache.get(kantor_id)
+    if stats is None:
+        stats = _load_dashboard_stats(kantor_id)
+        _dashboard_cache.set(kantor_id, stats)
+    elif 'latest_transaction' not in stats:
+        latest = _load_latest_transaction(kantor_id)
+        _dashboard_cache.update(kantor_id, lambda cached: cached.setdefault('latest_transaction', latest))
+        stats = dict(stats, latest_transaction=latest)
+    return stats
+
+def dashboard_stock_changed(kantor_id, changes, types_delta=0, deleted=False, new_transaction=False):
+    # changes: [(material, selisih_stok)] dengan material.jumlah sudah berisi nilai baru.
+    updates = []
+    for material, delta in changes:
+        updates.append((material.id, delta, material.jumlah, material.stok_minimum,
+                        None if deleted else _material_snapshot(material)))
+
+    def apply(stats):
+        stats['total_material_types'] += types_delta
+        for material_id, delta, jumlah, stok_minimum, snapshot in updates:
+            stats['total_stock'] += delta
+            threshold = stok_minimum if stok_minimum is not None else stats['threshold']
+            if snapshot is not None and jumlah < threshold:
+                stats['low_stock'][material_id] = snapshot
+            else:
+                stats['low_stock'].pop(material_id, None)
+        if new_transaction:
+            stats.pop('latest_transaction', None)
+    _dashboard_cache.update(kantor_id, apply)
+
+# --- Cache Izin Material ---
+# Per user disimpan (izin_versi, tuple id material yang diizinkan) terurut menurut nama material.
+# Di-invalidate saat izin diubah, material diganti nama/dihapus, atau user dihapus. Invalidasi itu
+# hanya berlaku di proses ini, jadi setiap pemakaian juga mencocokkan User.izin_versi: izin yang
+# dicabut lewat worker gunicorn lain langsung berlaku tanpa menunggu TTL.
+_permission_cache = _TTLCache('PERMISSION_CACHE_TTL')
+
+def permitted_material_ids(user_id):
+    versi = db.session.query(User.izin_versi).filter(User.id == user_id).scalar()
+    cached = _permission_cache.get(user_id)
+    if cached is not None and cached[0] == versi:
+        return cached[1]
+    material_ids = tuple(material_id for (material_id,) in
+                         db.session.query(Material.id)
+                         .join(user_material_permissions, user_material_permissions.c.material_id == Material.id)
+                         .filter(user_material_permissions.c.user_id == user_id)
+                         .order_by(Material.nama_material))
+    _permission_cache.set(user_id, (versi, material_ids))
+    return material_ids
+
+class RankedPagination(Pagination):
+    # Paginasi atas daftar id yang sudah diurutkan relevansinya; hanya material di halaman aktif yang dimuat.
+    def _query_items(self):
+        page_ids = self._query_args['ids'][self._query_offset:self._query_offset + self.per_page]
+        materials = {material.id: material for material in self._query_args['query'].filter(Material.id.in_(page_ids))} if page_ids else {}
+        return [materials[material_id] for material_id in page_ids if material_id in materials]
+
+    def _query_count(self):
+        return len(self._query_args['ids'])
+
 @app.route('/dashboard')
 @login_required
 def dashboard():
     user_kantor_id = session.get('kantor_id')
-    total_material_types = Material.query.filter_by(kantor_id=user_kantor_id).count()
-    total_stock = db.session.query(db.func.sum(Material.jumlah)).filter(Material.kantor_id == user_kantor_id).scalar() or 0
-    latest_transaction = Transaction.query.filter_by(kantor_id=user_kantor_id).order_by(Transaction.timestamp.desc()).first()
-    LOW_STOCK_THRESHOLD = 50 
-    low_stock_materials = Material.query.filter(Material.kantor_id == user_kantor_id, Material.jumlah < LOW_STOCK_THRESHOLD).order_by(Material.jumlah).all()
+    stats = dashboard_stats(user_kantor_id)
+    low_stock_materials = sorted(stats['low_stock'].values(), key=lambda material: material.jumlah)
     search_query = request.args.get('search', '')
     page = request.args.get('page', 1, type=int)
     query = Material.query.filter_by(kantor_id=user_kantor_id)
     if search_query:
-        search_term = f"%{search_query}%"
-        query = query.filter(db.or_(Material.nama_material.ilike(search_term), Material.id_barang.ilike(search_term)))
-    pagination = query.order_by(Material.nama_material).paginate(page=page, per_page=10, error_out=False)
-    return render_template('dashboard.html', pagination=pagination, search_query=search_query, total_material_types=total_material_types, total_stock=total_stock, latest_transaction=latest_transaction, low_stock_materials=low_stock_materials)
+        pagination = RankedPagination(page=page, per_page=10, error_out=False, ids=search_material_ids(user_kantor_id, search_query), query=query)
+    else:
+        pagination = query.order_by(Material.nama_material).paginate(page=page, per_page=10, error_out=False)
+    return render_template('dashboard.html', pagination=pagination, search_query=search_query, total_material_types=stats['total_material_types'], total_stock=stats['total_stock'], latest_transaction=stats['latest_transaction'], low_stock_materials=low_stock_materials, low_stock_threshold=stats['threshold'])
+
+@app.route('/materials/search')
+@login_required
+def material_typeahead():
+    user_kantor_id = session.get('kantor_id')
+    limit = max(1, min(request.args.get('limit', 10, type=int) or 10, 50))
+    permitted_user_id = None if session.get('role') == 'admin' else session['user_id']
+    ranked_ids = search_material_ids(user_kantor_id, request.args.get('q', ''), limit * 5, permitted_user_id)
+    query = Material.query.options(joinedload(Material.satuan)).filter(Material.id.in_(ranked_ids))
+    materials = {material.id: material for material in query}
+    results = [materials[material_id] for material_id in ranked_ids if material_id in materials][:limit]
+    return jsonify([{'id': m.id, 'id_barang': m.id_barang, 'nama_material': m.nama_material, 'jumlah': m.jumlah, 'satuan': m.satuan.nama} for m in results])
 
 @app.route('/logout')
 @login_required
@@ -124,27 +864,544 @@ def logout():
     flash('Kamu berhasil logout.', 'info')
     return redirect(url_for('login'))
 
+# --- Job Latar Belakang ---
+# Pekerjaan berat (impor, hapus riwayat) dijalankan di thread pool terpisah supaya thread
+# server tetap melayani UI. Status disimpan di tabel Job; progress job yang sedang jalan
+# disimpan di memori karena koneksi SQLite milik job sedang memegang write lock.
+JOB_HANDLERS = {}
+JOB_MAX_ERRORS = 1000
+_job_progress = {}
+_job_executor = None
+_job_executor_lock = threading.Lock()
+
+def job_handler(jenis):
+    def decorator(f):
+        JOB_HANDLERS[jenis] = f
+        return f
+    return decorator
+
+def _get_job_executor():
+    global _job_executor
+    with _job_executor_lock:
+        if _job_executor is None:
+            _job_executor = ThreadPoolExecutor(max_workers=app.config['JOB_WORKERS'], thread_name_prefix='minty-job')
+        return _job_executor
+
+def submit_job(jenis, kantor_id, user_id, params):
+    job = Job(id=uuid.uuid4().hex, jenis=jenis, status='queued', progress=0, params=json.dumps(params), kantor_id=kantor_id, user_id=user_id)
+    db.session.add(job)
+    db.session.commit()
+    _get_job_executor().submit(_run_job, job.id)
+    return job
+
+def _run_job(job_id):
+    with app.app_context():
+        # Klaim atomik: beberapa worker gunicorn bisa mengantrekan job queued yang sama.
+        claimed = Job.query.filter_by(id=job_id, status='queued').update({'status': 'running'}, synchronize_session=False)
+        db.session.commit()
+        if not claimed:
+            return
+        job = db.session.get(Job, job_id)
+        handler, params, kantor_id = JOB_HANDLERS[job.jenis], json.loads(job.params), job.kantor_id
+        _job_progress[job_id] = (0, None)
+
+        def progress(percent, pesan=None):
+            _job_progress[job_id] = (min(int(percent), 99), pesan)
+
+        try:
+            hasil = handler(params, kantor_id, progress)
+            db.session.commit()
+            status, pesan = 'done', None
+        except Exception as e:
+            db.session.rollback()
+            app.logger.exception('Job %s (%s) gagal', job_id, job.jenis)
+            hasil, status, pesan = None, 'failed', str(e)[:500]
+        finally:
+            _job_progress.pop(job_id, None)
+        job = db.session.get(Job, job_id)
+        job.status = status
+        job.progress = 100 if status == 'done' else job.progress
+        job.pesan = pesan
+        job.hasil = json.dumps(hasil) if hasil is not None else None
+        job.finished_at = db.func.now()
+        db.session.commit()
+
+def recover_jobs(fail_running=True, resume_queued=True):
+    # Desktop: keduanya sekali saat start. Gunicorn: job running ditandai gagal di master sebelum
+    # worker ada, job queued diantrekan ulang oleh setiap worker (klaim di _run_job mencegah dobel).
+    with app.app_context():
+        if fail_running:
+            Job.query.filter_by(status='running').update({'status': 'failed', 'pesan': 'Dihentikan karena aplikasi ditutup.'})
+            db.session.commit()
+        if resume_queued:
+            for (job_id,) in db.session.query(Job.id).filter_by(status='queued').order_by(Job.created_at).all():
+                _get_job_executor().submit(_run_job, job_id)
+
+def abandon_running_jobs():
+    # Dipanggil saat worker gunicorn berhenti: job yang belum mulai tetap queued untuk worker lain,
+    # job yang sedang berjalan di proses ini ditandai gagal supaya tidak tertahan "running".
+    if _job_executor is not None:
+        _job_executor.shutdown(wait=False, cancel_futures=True)
+    job_ids = list(_job_progress)
+    if not job_ids:
+        return
+    with app.app_context():
+        Job.query.filter(Job.id.in_(job_ids), Job.status == 'running').update(
+            {'status': 'failed', 'pesan': 'Worker server berhenti saat job berjalan.'}, synchronize_session=False)
+        db.session.commit()
+
+def _job_to_dict(job):
+    progress, pesan = _job_progress.get(job.id, (job.progress, job.pesan))
+    return {'id': job.id, 'jenis': job.jenis, 'status': job.status, 'progress': progress, 'pesan': pesan,
+            'hasil': json.loads(job.hasil) if job.hasil else None,
+            'created_at': job.created_at.isoformat() if job.created_at else None,
+            'finished_at': job.finished_at.isoformat() if job.finished_at else None}
+
+@app.route('/jobs/<job_id>')
+@login_required
+def job_status(job_id):
+    job = Job.query.filter_by(id=job_id, kantor_id=session.get('kantor_id')).first_or_404()
+    return jsonify(_job_to_dict(job))
+
+# --- Riwayat: filter & keyset pagination ---
+HISTORY_PER_PAGE = 50
+HISTORY_MAX_PER_PAGE = 200
+
+def _parse_date(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d') if value else None
+    except ValueError:
+        return None
+
+def _history_filters(args):
+    tipe = args.get('tipe_transaksi')
+    return {
+        'start': _parse_date(args.get('start')),
+        'end': _parse_date(args.get('end')),
+        'tipe_transaksi': tipe if tipe in ('IN', 'OUT') else None,
+        'material_id': args.get('material_id', type=int),
+        'user_id': args.get('user_id', type=int),
+    }
+
+def _filter_history(query, kantor_id, filters):
+    query = query.filter(Transaction.kantor_id == kantor_id)
+    if filters['start']:
+        query = query.filter(Transaction.timestamp >= filters['start'])
+    if filters['end']:
+        query = query.filter(Transaction.timestamp < filters['end'] + timedelta(days=1))
+    if filters['tipe_transaksi']:
+        query = query.filter(Transaction.tipe_transaksi == filters['tipe_transaksi'])
+    if filters['material_id']:
+        query = query.filter(Transaction.material_id == filters['material_id'])
+    if filters['user_id']:
+        query = query.filter(Transaction.user_id == filters['user_id'])
+    return query
+
+def _encode_cursor(timestamp, transaction_id):
+    return f"{timestamp.isoformat()}_{transaction_id}"
+
+def _decode_cursor(value):
+    try:
+        timestamp, transaction_id = value.rsplit('_', 1)
+        return datetime.fromisoformat(timestamp), int(transaction_id)
+    except (AttributeError, ValueError):
+        return None
+
+def _history_page(query, cursor, per_page):
+    # Keyset pada (timestamp, id) memakai index ix_transaction_kantor_timestamp_id,
+    # jadi biaya per halaman tetap walaupun ledger terus bertambah.
+    if cursor:
+        timestamp, transaction_id = cursor
+        query = query.filter(db.or_(Transaction.timestamp < timestamp,
+                                    db.and_(Transaction.timestamp == timestamp, Transaction.id < transaction_id)))
+    rows = query.order_by(Transaction.timestamp.desc(), Transaction.id.desc()).limit(per_page + 1).all()
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        next_cursor = _encode_cursor(rows[-1].timestamp, rows[-1].id)
+    return rows, next_cursor
+
+def _history_per_page():
+    # Dibatasi dua sisi: per_page <= 0 membuat LIMIT negatif (SQLite: tanpa batas, Postgres: error).
+    return max(1, min(request.args.get('per_page', HISTORY_PER_PAGE, type=int) or HISTORY_PER_PAGE, HISTORY_MAX_PER_PAGE))
+
+def history_page(query, kantor_id, filters, cursor, per_page):
+    transactions, next_cursor = _history_page(query, cursor, per_page)
+    if next_cursor is None:
+        # Tabel utama sudah habis untuk filter ini; sisa halaman diambil dari arsip.
+        transactions += islice(archived_history(kantor_id, filters, cursor), per_page - len(transactions) + 1)
+        if len(transactions) > per_page:
+            transactions = transactions[:per_page]
+            next_cursor = _encode_cursor(transactions[-1].timestamp, transactions[-1].id)
+    return transactions, next_cursor
+
 @app.route('/history')
 @login_required
 def history():
     user_kantor_id = session.get('kantor_id')
-    all_transactions = (Transaction.query.options(joinedload(Transaction.material), joinedload(Transaction.user)).filter_by(kantor_id=user_kantor_id).order_by(Transaction.timestamp.desc()).all())
-    return render_template('history.html', transactions=all_transactions)
+    filters = _history_filters(request.args)
+    per_page = _history_per_page()
+    cursor = _decode_cursor(request.args.get('cursor'))
+    query = _filter_history(Transaction.query.options(joinedload(Transaction.material), joinedload(Transaction.user)), user_kantor_id, filters)
+    transactions, next_cursor = history_page(query, user_kantor_id, filters, cursor, per_page)
+    filter_args = {key: value for key, value in request.args.items() if key != 'cursor' and value}
+    next_url = url_for('history', cursor=next_cursor, **filter_args) if next_cursor else None
+    filter_materials = db.session.query(Material.id, Material.nama_material).filter(Material.kantor_id == user_kantor_id).order_by(Material.nama_material).all()
+    filter_users = db.session.query(User.id, User.username).filter(User.kantor_id == user_kantor_id).order_by(User.username).all()
+    return render_template('history.html', transactions=transactions, next_url=next_url, first_url=url_for('history', **filter_args) if cursor else None,
+                           filters=filter_args, filter_materials=filter_materials, filter_users=filter_users)
+
+CLEAR_HISTORY_BATCH = 5000
+
+@job_handler('clear_history')
+def _clear_history_job(params, kantor_id, progress):
+    # Dihapus per batch dan di-commit per batch supaya write lock tidak ditahan terlalu lama.
+    total = Transaction.query.filter_by(kantor_id=kantor_id).count()
+    deleted = 0
+    while True:
+        ids = [row.id for row in db.session.query(Transaction.id).filter_by(kantor_id=kantor_id).limit(CLEAR_HISTORY_BATCH)]
+        if not ids:
+            break
+        Transaction.query.filter(Transaction.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+        deleted += len(ids)
+        progress(deleted * 100 / max(total, 1))
+    _dashboard_cache.pop(kantor_id)
+    return {'deleted': deleted}
 
 @app.route('/history/clear', methods=['POST'])
 @login_required
 @admin_required
 def clear_history():
     try:
-        user_kantor_id = session.get('kantor_id')
-        Transaction.query.filter_by(kantor_id=user_kantor_id).delete()
-        db.session.commit()
-        flash('Semua riwayat transaksi untuk kantor ini berhasil dihapus!', 'success')
+        job = submit_job('clear_history', session.get('kantor_id'), session['user_id'], {})
+        flash('Penghapusan riwayat transaksi sedang diproses di latar belakang.', 'info')
+        return redirect(url_for('history', job_id=job.id))
     except Exception as e:
         db.session.rollback()
         flash(f'Terjadi error saat menghapus riwayat: {e}', 'danger')
     return redirect(url_for('history'))
 
+# --- Arsip Riwayat ---
+# Transaksi lama dipindah ke file SQLite terpisah per kantor per tahun (ARCHIVE_DIR). Snapshot stok
+# dan rollup harian dibangun lebih dulu sehingga stok, stock_at dan laporan tidak berubah. Semua
+# baris arsip lebih tua dari baris di tabel utama, jadi /history dan ekspor cukup menyambung ke
+# arsip setelah tabel utama habis untuk filter tersebut.
+ARCHIVE_DEFAULT_DAYS = 365
+ARCHIVE_BATCH = 5000
+ARCHIVE_COLUMNS = ('id', 'timestamp', 'tipe_transaksi', 'material_id', 'id_barang', 'nama_material', 'jumlah', 'sumber', 'user_id', 'username')
+# id transaksi bukan kunci arsip: SQLite memakai ulang id setelah tabel transaksi kosong (tanpa
+# AUTOINCREMENT), jadi dua transaksi berbeda bisa punya id yang sama di satu file arsip.
+ARCHIVE_SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS transaction_archive (arsip_id INTEGER PRIMARY KEY AUTOINCREMENT, id INTEGER NOT NULL, timestamp TEXT NOT NULL, '
+    'tipe_transaksi TEXT NOT NULL, material_id INTEGER NOT NULL, id_barang TEXT, nama_material TEXT, jumlah INTEGER NOT NULL, sumber TEXT, '
+    'user_id INTEGER NOT NULL, username TEXT)',
+    'CREATE INDEX IF NOT EXISTS ix_archive_id ON transaction_archive (id)',
+    'CREATE INDEX IF NOT EXISTS ix_archive_timestamp_id ON transaction_archive (timestamp, id)',
+    'CREATE INDEX IF NOT EXISTS ix_archive_material_timestamp ON transaction_archive (material_id, timestamp)',
+)
+# Baris arsip dianggap sama dengan transaksi hanya bila semua kolom transaksinya identik
+# (nama material/username boleh berbeda karena bisa diganti setelah diarsipkan).
+ARCHIVE_IDENTITY = 'id = ? AND timestamp = ? AND tipe_transaksi = ? AND material_id = ? AND jumlah = ? AND sumber IS ? AND user_id = ?'
+
+def _archive_timestamp(value):
+    return value.isoformat(sep=' ')
+
+def _open_archive(segment):
+    return sqlite3.connect(f"file:{os.path.join(app.config['ARCHIVE_DIR'], segment.nama_file)}?mode=ro", uri=True)
+
+def _upgrade_archive(connection):
+    # File arsip lama memakai id transaksi sebagai PRIMARY KEY; pindahkan ke skema dengan arsip_id.
+    columns = [row[1] for row in connection.execute('PRAGMA table_info(transaction_archive)')]
+    if not columns or 'arsip_id' in columns:
+        return
+    connection.execute('ALTER TABLE transaction_archive RENAME TO transaction_archive_lama')
+    connection.execute('DROP INDEX IF EXISTS ix_archive_timestamp_id')
+    connection.execute('DROP INDEX IF EXISTS ix_archive_material_timestamp')
+    for ddl in ARCHIVE_SCHEMA:
+        connection.execute(ddl)
+    connection.execute(f"INSERT INTO transaction_archive ({', '.join(ARCHIVE_COLUMNS)}) SELECT {', '.join(ARCHIVE_COLUMNS)} "
+                       'FROM transaction_archive_lama ORDER BY id')
+    connection.execute('DROP TABLE transaction_archive_lama')
+
+def _archived_ids(connection, rows):
+    sql = f'SELECT 1 FROM transaction_archive WHERE {ARCHIVE_IDENTITY} LIMIT 1'
+    return {row[0] for row in rows if connection.execute(sql, (*row[:4], *row[6:9])).fetchone()}
+
+def _write_archive(kantor_id, tahun, rows):
+    segment = ArchiveSegment.query.filter_by(kantor_id=kantor_id, tahun=tahun).first() or \
+        ArchiveSegment(kantor_id=kantor_id, tahun=tahun, nama_file=f'kantor_{kantor_id}_{tahun}.sqlite')
+    os.makedirs(app.config['ARCHIVE_DIR'], exist_ok=True)
+    with closing(sqlite3.connect(os.path.join(app.config['ARCHIVE_DIR'], segment.nama_file))) as connection:
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            _upgrade_archive(connection)
+            for ddl in ARCHIVE_SCHEMA:
+                connection.execute(ddl)
+            # Batch yang sudah tertulis tapi belum sempat dihapus dari tabel utama aman diulang: baris
+            # identik dilewati, sedangkan id sama dengan isi berbeda (id dipakai ulang) tetap ditulis.
+            archived = _archived_ids(connection, rows)
+            connection.executemany(f"INSERT INTO transaction_archive ({', '.join(ARCHIVE_COLUMNS)}) VALUES ({', '.join('?' * len(ARCHIVE_COLUMNS))})",
+                                   [row for row in rows if row[0] not in archived])
+        # Transaksi baru boleh dihapus dari tabel utama setelah barisnya terbukti ada di file arsip.
+        if len(_archived_ids(connection, rows)) != len(rows):
+            raise RuntimeError(f'Arsip {segment.nama_file} tidak lengkap, transaksi tidak dihapus dari database utama.')
+        jumlah_baris, ts_min, ts_max = connection.execute('SELECT COUNT(*), MIN(timestamp), MAX(timestamp) FROM transaction_archive').fetchone()
+    segment.jumlah_baris, segment.ts_min, segment.ts_max = jumlah_baris, datetime.fromisoformat(ts_min), datetime.fromisoformat(ts_max)
+    db.session.add(segment)
+    return segment
+
+def archive_history(kantor_id, days, progress=None):
+    cutoff = _day_start(_utc_today() - timedelta(days=days))
+    build_stock_snapshots(kantor_id)
+    build_daily_rollups(kantor_id)
+    db.session.commit()
+    old = db.session.query(Transaction.id).filter(Transaction.kantor_id == kantor_id, Transaction.timestamp < cutoff)
+    total = old.count()
+    archived, segments = 0, {}
+    while True:
+        rows = (db.session.query(Transaction.id, Transaction.timestamp, Transaction.tipe_transaksi, Transaction.material_id, Material.id_barang,
+                                 Material.nama_material, Transaction.jumlah, Transaction.sumber, Transaction.user_id, User.username)
+                .join(Material, Transaction.material_id == Material.id).join(User, Transaction.user_id == User.id)
+                .filter(Transaction.kantor_id == kantor_id, Transaction.timestamp < cutoff)
+                .order_by(Transaction.id).limit(ARCHIVE_BATCH).all())
+        if not rows:
+            break
+        per_year = {}
+        for row in rows:
+            per_year.setdefault(row.timestamp.year, []).append((row.id, _archive_timestamp(row.timestamp), *row[2:]))
+        for tahun, year_rows in per_year.items():
+            segments[tahun] = _write_archive(kantor_id, tahun, year_rows)
+        Transaction.query.filter(Transaction.id.in_([row.id for row in rows])).delete(synchronize_session=False)
+        db.session.commit()
+        archived += len(rows)
+        if progress:
+            progress(archived * 100 / max(total, 1))
+    for segment in segments.values():
+        with closing(sqlite3.connect(os.path.join(app.config['ARCHIVE_DIR'], segment.nama_file))) as connection:
+            connection.execute('VACUUM')
+    if archived:
+        _dashboard_cache.pop(kantor_id)
+    return archived
+
+def _archive_segments(kantor_id, start=None, end=None, before=None):
+    query = ArchiveSegment.query.filter_by(kantor_id=kantor_id)
+    if start:
+        query = query.filter(ArchiveSegment.ts_max >= start)
+    if end:
+        query = query.filter(ArchiveSegment.ts_min < end)
+    if before:
+        query = query.filter(ArchiveSegment.ts_min <= before)
+    return query.order_by(ArchiveSegment.tahun.desc()).all()
+
+def _archived_transaction(row):
+    values = dict(zip(ARCHIVE_COLUMNS, row))
+    return SimpleNamespace(id=values['id'], timestamp=datetime.fromisoformat(values['timestamp']), tipe_transaksi=values['tipe_transaksi'],
+                           jumlah=values['jumlah'], sumber=values['sumber'], material_id=values['material_id'], user_id=values['user_id'],
+                           material=SimpleNamespace(id=values['material_id'], id_barang=values['id_barang'], nama_material=values['nama_material']),
+                           user=SimpleNamespace(id=values['user_id'], username=values['username']), arsip=True)
+
+def archived_history(kantor_id, filters, cursor=None):
+    # Generator baris arsip terurut (timestamp, id) menurun; file per tahun hanya dibuka bila rentangnya relevan.
+    end = filters['end'] + timedelta(days=1) if filters['end'] else None
+    conditions, params = [], []
+    if filters['start']:
+        conditions.append('timestamp >= ?')
+        params.append(_archive_timestamp(filters['start']))
+    if end:
+        conditions.append('timestamp < ?')
+        params.append(_archive_timestamp(end))
+    for column in ('tipe_transaksi', 'material_id', 'user_id'):
+        if filters[column]:
+            conditions.append(f'{column} = ?')
+            params.append(filters[column])
+    if cursor:
+        conditions.append('(timestamp < ? OR (timestamp = ? AND id < ?))')
+        params += [_archive_timestamp(cursor[0]), _archive_timestamp(cursor[0]), cursor[1]]
+    sql = f"SELECT {', '.join(ARCHIVE_COLUMNS)} FROM transaction_archive"
+    if conditions:
+        sql += ' WHERE ' + ' AND '.join(conditions)
+    sql += ' ORDER BY timestamp DESC, id DESC'
+    for segment in _archive_segments(kantor_id, filters['start'], end, cursor[0] if cursor else None):
+        with closing(_open_archive(segment)) as connection:
+            rows = connection.execute(sql, params)
+            while True:
+                batch = rows.fetchmany(EXPORT_BATCH)
+                if not batch:
+                    break
+                for row in batch:
+                    yield _archived_transaction(row)
+
+def archived_movement_sum(kantor_id, material_id, since, until=None):
+    sql = "SELECT COALESCE(SUM(CASE WHEN tipe_transaksi = 'IN' THEN jumlah ELSE -jumlah END), 0) FROM transaction_archive WHERE material_id = ? AND timestamp >= ?"
+    params = [material_id, _archive_timestamp(since)]
+    if until:
+        sql += ' AND timestamp < ?'
+        params.append(_archive_timestamp(until))
+    total = 0
+    for segment in _archive_segments(kantor_id, since, until):
+        with closing(_open_archive(segment)) as connection:
+            total += connection.execute(sql, params).fetchone()[0]
+    return total
+
+def archived_ids(column, ids, kantor_id=None):
+    # id material/user yang masih punya baris di file arsip. Dipakai pengecekan hapus: tanpa ini data
+    # dengan riwayat yang sudah diarsipkan bisa dihapus, dan id yang dipakai ulang SQLite mewarisi ledger arsipnya.
+    query = ArchiveSegment.query if kantor_id is None else ArchiveSegment.query.filter_by(kantor_id=kantor_id)
+    found = set()
+    for segment in query.all():
+        with closing(_open_archive(segment)) as connection:
+            for batch in _batched([row_id for row_id in ids if row_id not in found], IMPORT_LOOKUP_BATCH):
+                found.update(row_id for (row_id,) in connection.execute(
+                    f"SELECT DISTINCT {column} FROM transaction_archive WHERE {column} IN ({', '.join('?' * len(batch))})", batch))
+    return found
+
+@job_handler('archive_history')
+def _archive_history_job(params, kantor_id, progress):
+    return {'archived': archive_history(kantor_id, params['days'], progress)}
+
+@app.route('/history/archive', methods=['POST'])
+@login_required
+@admin_required
+def archive_old_history():
+    days = request.form.get('days', ARCHIVE_DEFAULT_DAYS, type=int)
+    if days is None or days < 1:
+        flash('Umur transaksi yang diarsipkan minimal 1 hari.', 'danger')
+        return redirect(url_for('history'))
+    job = submit_job('archive_history', session.get('kantor_id'), session['user_id'], {'days': days})
+    flash(f'Transaksi yang lebih lama dari {days} hari sedang dipindahkan ke arsip.', 'info')
+    return redirect(url_for('history', job_id=job.id))
+
+# --- Ekspor CSV/XLSX ---
+# Baris dibaca lewat yield_per (server-side cursor di Postgres) dan dikirim per potongan,
+# jadi memori tetap kecil walaupun ledger berisi jutaan baris.
+EXPORT_BATCH = 1000
+EXPORT_CHUNK_BYTES = 64 * 1024
+EXPORT_FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+
+def _csv_chunks(header, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write('\ufeff')
+    writer.writerow(header)
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() >= EXPORT_CHUNK_BYTES:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+    yield buffer.getvalue()
+
+def _xlsx_chunks(title, header, rows):
+    # Workbook write_only menulis baris ke file sementara, bukan ke memori; format zip XLSX
+    # baru bisa dikirim setelah workbook selesai ditulis.
+    from openpyxl import Workbook
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet(title)
+    sheet.append(header)
+    for row in rows:
+        sheet.append(list(row))
+    with tempfile.TemporaryFile() as output:
+        workbook.save(output)
+        output.seek(0)
+        while True:
+            chunk = output.read(EXPORT_CHUNK_BYTES)
+            if not chunk:
+                break
+            yield chunk
+
+def _export_response(filename, title, header, rows):
+    export_format = request.args.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        export_format = 'csv'
+    chunks = _xlsx_chunks(title, header, rows) if export_format == 'xlsx' else _csv_chunks(header, rows)
+    return Response(stream_with_context(chunks), mimetype=EXPORT_FORMATS[export_format],
+                    headers={'Content-Disposition': f'attachment; filename={filename}.{export_format}'})
+
+@app.route('/history/export')
+@login_required
+def export_history():
+    query = (db.session.query(Transaction.timestamp, Transaction.tipe_transaksi, Material.id_barang, Material.nama_material,
+                              Transaction.jumlah, Transaction.sumber, User.username)
+             .join(Material, Transaction.material_id == Material.id).join(User, Transaction.user_id == User.id))
+    filters = _history_filters(request.args)
+    query = _filter_history(query, session.get('kantor_id'), filters)
+    archived = ((row.timestamp, row.tipe_transaksi, row.material.id_barang, row.material.nama_material, row.jumlah, row.sumber, row.user.username)
+                for row in archived_history(session.get('kantor_id'), filters))
+    rows = chain(query.order_by(Transaction.timestamp.desc(), Transaction.id.desc()).yield_per(EXPORT_BATCH), archived)
+    header = ['Waktu', 'Tipe', 'ID Barang', 'Nama Material', 'Jumlah', 'Sumber/Tujuan', 'User']
+    return _export_response(f'riwayat_transaksi_{date.today().isoformat()}', 'Riwayat', header, rows)
+
+@app.route('/materials/export')
+@login_required
+def export_materials():
+    rows = (db.session.query(Material.id_barang, Material.nama_material, Material.jumlah, Satuan.nama, Material.stok_minimum)
+            .join(Satuan, Material.satuan_id == Satuan.id).filter(Material.kantor_id == session.get('kantor_id'))
+            .order_by(Material.nama_material).yield_per(EXPORT_BATCH))
+    header = ['ID Barang', 'Nama Material', 'Jumlah', 'Satuan', 'Stok Minimum']
+    return _export_response(f'stok_material_{date.today().isoformat()}', 'Stok', header, rows)
+
+# --- Mesin Pergerakan Stok ---
+class StockError(Exception):
+    def __init__(self, shortages):
+        self.shortages = shortages
+        super().__init__(', '.join(f"{nama} (stok {stok}, diminta {diminta})" for nama, stok, diminta in shortages))
+
+def _begin_stock_transaction():
+    # Postgres memakai SELECT ... FOR UPDATE; SQLite tidak punya row lock, jadi tulis-lock
+    # database diambil di awal agar dua petugas tidak membaca stok yang sama bersamaan.
+    connection = db.session.connection()
+    if connection.dialect.name != 'sqlite':
+        return
+    raw = connection.connection
+    raw = getattr(raw, 'dbapi_connection', None) or raw.connection
+    if not raw.in_transaction:
+        connection.exec_driver_sql('BEGIN IMMEDIATE')
+
+def apply_stock_movements(kantor_id, user_id, tipe_transaksi, lines, sumber):
+    # lines: [(material_id, jumlah)] dengan jumlah > 0. Commit/rollback tetap tanggung jawab pemanggil.
+    # Mengembalikan [(material, selisih)] untuk material yang benar-benar berubah.
+    sign = 1 if tipe_transaksi == 'IN' else -1
+    deltas = {}
+    for material_id, jumlah in lines:
+        deltas[material_id] = deltas.get(material_id, 0) + sign * jumlah
+    if not deltas:
+        return []
+    _begin_stock_transaction()
+    materials = {m.id: m for m in (Material.query.options(joinedload(Material.satuan, innerjoin=True))
+                                   .filter(Material.id.in_(list(deltas)), Material.kantor_id == kantor_id)
+                                   .with_for_update(of=Material).all())}
+    deltas = {material_id: delta for material_id, delta in deltas.items() if material_id in materials}
+    if not deltas:
+        return []
+    shortages = [(materials[material_id].nama_material, materials[material_id].jumlah, -delta)
+                 for material_id, delta in deltas.items() if materials[material_id].jumlah + delta < 0]
+    if shortages:
+        raise StockError(shortages)
+    delta_case = db.case(deltas, value=Material.id)
+    updated = (Material.query
+               .filter(Material.id.in_(list(deltas)), Material.kantor_id == kantor_id, Material.jumlah + delta_case >= 0)
+               .update({Material.jumlah: Material.jumlah + delta_case}, synchronize_session=False))
+    if updated != len(deltas):
+        current = dict(db.session.query(Material.id, Material.jumlah).filter(Material.id.in_(list(deltas))).all())
+        raise StockError([(materials[material_id].nama_material, current.get(material_id, 0), -delta)
+                          for material_id, delta in deltas.items() if current.get(material_id, 0) + delta < 0])
+    db.session.execute(Transaction.__table__.insert(), [
+        {'material_id': material_id, 'tipe_transaksi': tipe_transaksi, 'jumlah': jumlah, 'sumber': sumber,
+         'user_id': user_id, 'kantor_id': kantor_id}
+        for material_id, jumlah in lines if material_id in deltas])
+    record_sync_changes('material', list(deltas), kantor_id)
+    if app.config['SYNC_REMOTE_URL']:
+        queue_sync_movement(kantor_id, user_id, tipe_transaksi, [(material_id, jumlah) for material_id, jumlah in lines if material_id in deltas], sumber)
+    changes = []
+    for material_id, delta in deltas.items():
+        set_committed_value(materials[material_id], 'jumlah', materials[material_id].jumlah + delta)
+        changes.append((materials[material_id], delta))
+    return changes
+
 @app.route('/transaction/new', methods=['GET', 'POST'])
 @login_required
 def new_transaction():
@@ -152,51 +1409,909 @@ def new_transaction():
     if request.method == 'POST':
         try:
             tipe_transaksi = request.form.get('tipe_transaksi')
-            material_ids = request.form.getlist('material_id')
-            jumlahs = request.form.getlist('jumlah')
+            changes = []
+            lines = []
+            for material_id, jumlah in zip(request.form.getlist('material_id'), request.form.getlist('jumlah')):
+                jumlah = int(jumlah)
+                if not material_id or jumlah <= 0: continue
+                lines.append((int(material_id), jumlah))
             if tipe_transaksi == 'IN':
-                sumber = request.form.get('sumber_in')
-                for i in range(len(material_ids)):
-                    material_id = material_ids[i]
-                    jumlah = int(jumlahs[i])
-                    if not material_id or jumlah <= 0: continue
-                    material = Material.query.filter_by(id=material_id, kantor_id=user_kantor_id).first()
-                    if material:
-                        material.jumlah += jumlah
-                        db.session.add(Transaction(material_id=material.id, tipe_transaksi='IN', jumlah=jumlah, sumber=sumber, user_id=session['user_id'], kantor_id=user_kantor_id))
+                changes = apply_stock_movements(user_kantor_id, session['user_id'], 'IN', lines, request.form.get('sumber_in'))
             elif tipe_transaksi == 'OUT':
                 metode = request.form.get('metode_out')
                 sumber_tujuan = request.form.get('online_option') or request.form.get('manual_option')
-                for i in range(len(material_ids)):
-                    material_id = material_ids[i]
-                    jumlah_keluar = int(jumlahs[i])
-                    if not material_id or jumlah_keluar <= 0: continue
-                    material = Material.query.filter_by(id=material_id, kantor_id=user_kantor_id).first()
-                    if material:
-                        if material.jumlah < jumlah_keluar:
-                            flash(f"Gagal! Stok {material.nama_material} tidak cukup.", 'danger')
-                            db.session.rollback()
-                            return redirect(url_for('new_transaction'))
-                        material.jumlah -= jumlah_keluar
-                        db.session.add(Transaction(material_id=material.id, tipe_transaksi='OUT', jumlah=jumlah_keluar, sumber=f"{metode} - {sumber_tujuan}", user_id=session['user_id'], kantor_id=user_kantor_id))
+                changes = apply_stock_movements(user_kantor_id, session['user_id'], 'OUT', lines, f"{metode} - {sumber_tujuan}")
             db.session.commit()
+            dashboard_stock_changed(user_kantor_id, changes, new_transaction=bool(changes))
             flash("Transaksi berhasil diproses!", "success")
             return redirect(url_for('dashboard'))
+        except StockError as e:
+            db.session.rollback()
+            flash(f"Gagal! Stok tidak cukup: {e}", 'danger')
+            return redirect(url_for('new_transaction'))
         except Exception as e:
             db.session.rollback()
             flash(f"Terjadi error: {e}", 'danger')
             return redirect(url_for('new_transaction'))
 
+    columns = db.session.query(Material.id, Material.nama_material, Material.jumlah)
     if session.get('role') == 'admin':
-        available_materials = Material.query.filter_by(kantor_id=user_kantor_id).order_by(Material.nama_material).all()
+        available_materials = columns.filter(Material.kantor_id == user_kantor_id).order_by(Material.nama_material).all()
     else:
-        current_user = User.query.get(session['user_id'])
-        available_materials = current_user.permitted_materials
-        available_materials.sort(key=lambda x: x.nama_material)
+        material_ids = permitted_material_ids(session['user_id'])
+        rows = {row.id: row for row in columns.filter(Material.id.in_(material_ids))} if material_ids else {}
+        available_materials = [rows[material_id] for material_id in material_ids if material_id in rows]
 
     materials_list = [{'id': m.id, 'nama_material': m.nama_material, 'jumlah': m.jumlah} for m in available_materials]
     return render_template('form_transaksi.html', materials=materials_list)
 
+# --- Snapshot Stok & Rekonsiliasi ---
+SNAPSHOT_INSERT_BATCH = 1000
+
+def _insert_ignore(table, rows):
+    # Scheduler, job snapshot, dan arsip bisa membangun hari yang sama bersamaan (juga lintas worker
+    # gunicorn); baris (material_id, tanggal) yang sudah ada dilewati, bukan IntegrityError.
+    dialect = db.session.connection().dialect.name
+    if dialect == 'sqlite':
+        statement = sqlite.insert(table).on_conflict_do_nothing()
+    elif dialect == 'postgresql':
+        statement = postgresql.insert(table).on_conflict_do_nothing()
+    else:
+        statement = table.insert()
+    for batch in _batched(rows, SNAPSHOT_INSERT_BATCH):
+        db.session.execute(statement, batch)
+
+def _signed_jumlah():
+    return db.case((Transaction.tipe_transaksi == 'IN', Transaction.jumlah), else_=-Transaction.jumlah)
+
+def _as_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return date.fromisoformat(str(value)[:10])
+
+def _day_start(day):
+    return datetime.combine(day, dt_time.min)
+
+def _utc_today():
+    # Timestamp transaksi tersimpan dalam UTC, jadi batas "hari lengkap" juga harus UTC;
+    # date.today() di WIB akan membekukan hari UTC yang belum selesai antara pukul 00:00-07:00.
+    return datetime.utcnow().date()
+
+def build_stock_snapshots(kantor_id, until=None):
+    # Membangun snapshot untuk hari-hari yang sudah lengkap (< until, default hari ini) yang
+    # belum punya snapshot. Inkremental: hanya transaksi setelah snapshot terakhir yang dibaca.
+    until = until or _utc_today()
+    _begin_stock_transaction()
+    last_day = db.session.query(db.func.max(StockSnapshot.tanggal)).filter(StockSnapshot.kantor_id == kantor_id).scalar()
+    if last_day is not None:
+        start = _as_date(last_day) + timedelta(days=1)
+    else:
+        first_timestamp = db.session.query(db.func.min(Transaction.timestamp)).filter(Transaction.kantor_id == kantor_id).scalar()
+        if first_timestamp is None:
+            return 0
+        start = _as_date(first_timestamp)
+    if start >= until:
+        return 0
+    daily = (db.session.query(Transaction.material_id, db.func.date(Transaction.timestamp), db.func.sum(_signed_jumlah()))
+             .filter(Transaction.kantor_id == kantor_id, Transaction.timestamp >= _day_start(start), Transaction.timestamp < _day_start(until))
+             .group_by(Transaction.material_id, db.func.date(Transaction.timestamp))
+             .order_by(db.func.date(Transaction.timestamp)).all())
+    material_ids = list({material_id for material_id, _, _ in daily})
+    closing = {}
+    for ids in _batched(material_ids, IMPORT_LOOKUP_BATCH):
+        latest = (db.session.query(StockSnapshot.material_id, db.func.max(StockSnapshot.tanggal).label('tanggal'))
+                  .filter(StockSnapshot.material_id.in_(ids)).group_by(StockSnapshot.material_id).subquery())
+        closing.update(db.session.query(StockSnapshot.material_id, StockSnapshot.jumlah)
+                       .join(latest, db.and_(StockSnapshot.material_id == latest.c.material_id, StockSnapshot.tanggal == latest.c.tanggal)).all())
+    # Material tanpa snapshot: stok awal diturunkan mundur dari stok sekarang dikurangi
+    # semua pergerakan sejak awal jendela.
+    new_ids = [material_id for material_id in material_ids if material_id not in closing]
+    for ids in _batched(new_ids, IMPORT_LOOKUP_BATCH):
+        current = dict(db.session.query(Material.id, Material.jumlah).filter(Material.id.in_(ids)).all())
+        moved = dict(db.session.query(Transaction.material_id, db.func.sum(_signed_jumlah()))
+                     .filter(Transaction.material_id.in_(ids), Transaction.timestamp >= _day_start(start))
+                     .group_by(Transaction.material_id).all())
+        closing.update({material_id: current.get(material_id, 0) - (moved.get(material_id) or 0) for material_id in ids})
+    rows = []
+    for material_id, tanggal, net in daily:
+        closing[material_id] += net
+        rows.append({'material_id': material_id, 'kantor_id': kantor_id, 'tanggal': _as_date(tanggal), 'jumlah': closing[material_id]})
+    _insert_ignore(StockSnapshot.__table__, rows)
+    return len(rows)
+
+def stock_at(material, at):
+    snapshot = (StockSnapshot.query.filter(StockSnapshot.material_id == material.id, StockSnapshot.tanggal < at.date())
+                .order_by(StockSnapshot.tanggal.desc()).first())
+    net = db.session.query(db.func.coalesce(db.func.sum(_signed_jumlah()), 0)).filter(Transaction.material_id == material.id)
+    if snapshot is None:
+        return material.jumlah - net.filter(Transaction.timestamp >= at).scalar() - archived_movement_sum(material.kantor_id, material.id, at)
+    since = _day_start(snapshot.tanggal + timedelta(days=1))
+    return (snapshot.jumlah + net.filter(Transaction.timestamp >= since, Transaction.timestamp < at).scalar()
+            + archived_movement_sum(material.kantor_id, material.id, since, at))
+
+def reconcile_stock(kantor_id):
+    # Setelah snapshot dibangun sampai kemarin, ledger setiap material = snapshot terakhir +
+    # transaksi hari ini. Material tanpa snapshot belum punya ledger pembanding.
+    build_stock_snapshots(kantor_id)
+    today = _day_start(_utc_today())
+    latest = (db.session.query(StockSnapshot.material_id, db.func.max(StockSnapshot.tanggal).label('tanggal'))
+              .filter(StockSnapshot.kantor_id == kantor_id).group_by(StockSnapshot.material_id).subquery())
+    snapshots = (db.session.query(Material, StockSnapshot.jumlah)
+                 .join(latest, latest.c.material_id == Material.id)
+                 .join(StockSnapshot, db.and_(StockSnapshot.material_id == latest.c.material_id, StockSnapshot.tanggal == latest.c.tanggal)).all())
+    moved_today = dict(db.session.query(Transaction.material_id, db.func.sum(_signed_jumlah()))
+                       .filter(Transaction.kantor_id == kantor_id, Transaction.timestamp >= today).group_by(Transaction.material_id).all())
+    mismatches = []
+    for material, snapshot_jumlah in snapshots:
+        ledger = snapshot_jumlah + (moved_today.get(material.id) or 0)
+        if ledger != material.jumlah:
+            mismatches.append({'material_id': material.id, 'id_barang': material.id_barang, 'nama_material': material.nama_material,
+                               'jumlah': material.jumlah, 'ledger': ledger, 'selisih': material.jumlah - ledger})
+    return mismatches
+
+@job_handler('build_snapshots')
+def _build_snapshots_job(params, kantor_id, progress):
+    # Laporan konsolidasi membaca rollup semua kantor, jadi job manual juga membangun semua kantor.
+    office_ids = [office_id for (office_id,) in db.session.query(Kantor.id).order_by(Kantor.id).all()]
+    hasil = {'snapshots': 0, 'rollups': 0}
+    for index, office_id in enumerate(office_ids):
+        hasil['snapshots'] += build_stock_snapshots(office_id)
+        hasil['rollups'] += build_daily_rollups(office_id)
+        db.session.commit()
+        progress((index + 1) * 100 / len(office_ids))
+    return hasil
+
+SNAPSHOT_LOCK_KEY = 7310001
+
+@contextmanager
+def _single_runner(lock_key):
+    # Di Postgres beberapa worker gunicorn menjalankan scheduler; advisory lock memastikan hanya satu
+    # yang bekerja per putaran. SQLite (desktop) hanya punya satu proses.
+    if db.engine.dialect.name != 'postgresql':
+        yield True
+        return
+    with db.engine.connect() as connection:
+        acquired = connection.execute(db.text('SELECT pg_try_advisory_lock(:key)'), {'key': lock_key}).scalar()
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                connection.execute(db.text('SELECT pg_advisory_unlock(:key)'), {'key': lock_key})
+            connection.commit()
+
+def run_snapshot_round():
+    with _single_runner(SNAPSHOT_LOCK_KEY) as acquired:
+        if not acquired:
+            return False
+        for (kantor_id,) in db.session.query(Kantor.id).all():
+            try:
+                build_stock_snapshots(kantor_id)
+                build_daily_rollups(kantor_id)
+                db.session.commit()
+                if app.config['ARCHIVE_AFTER_DAYS']:
+                    archive_history(kantor_id, app.config['ARCHIVE_AFTER_DAYS'])
+            except Exception:
+                db.session.rollback()
+                app.logger.exception('Gagal membangun snapshot stok kantor %s', kantor_id)
+        try:
+            prune_sync_changes()
+        except Exception:
+            db.session.rollback()
+            app.logger.exception('Gagal memangkas log perubahan sinkronisasi')
+        return True
+
+def start_snapshot_scheduler():
+    def loop():
+        while True:
+            with app.app_context():
+                try:
+                    run_snapshot_round()
+                except Exception:
+                    db.session.rollback()
+                    app.logger.exception('Putaran snapshot stok gagal')
+            time.sleep(app.config['SNAPSHOT_INTERVAL'])
+    threading.Thread(target=loop, daemon=True, name='minty-snapshot').start()
+
+@app.cli.command('build-snapshots')
+def build_snapshots_command():
+    # Untuk cron bila scheduler di dalam server dimatikan: flask --app app build-snapshots
+    if not run_snapshot_round():
+        print('Putaran snapshot sedang dijalankan proses lain.')
+
+@app.route('/stock/at')
+@login_required
+def stock_at_time():
+    material = Material.query.filter_by(id=request.args.get('material_id', type=int), kantor_id=session.get('kantor_id')).first_or_404()
+    try:
+        at = datetime.fromisoformat(request.args.get('at', ''))
+    except ValueError:
+        return jsonify({'error': 'Parameter "at" harus berformat ISO, contoh 2024-01-01 atau 2024-01-01T08:00.'}), 400
+    return jsonify({'material_id': material.id, 'id_barang': material.id_barang, 'at': at.isoformat(), 'jumlah': stock_at(material, at)})
+
+@app.route('/admin/stock/snapshots', methods=['POST'])
+@login_required
+@admin_required
+def build_snapshots():
+    job = submit_job('build_snapshots', session.get('kantor_id'), session['user_id'], {})
+    flash('Snapshot stok sedang dibangun di latar belakang.', 'info')
+    return redirect(url_for('stock_reconciliation', job_id=job.id))
+
+@app.route('/admin/stock/reconcile')
+@login_required
+@admin_required
+def stock_reconciliation():
+    mismatches = reconcile_stock(session.get('kantor_id'))
+    db.session.commit()
+    return render_template('admin_reconcile.html', mismatches=mismatches, job_id=request.args.get('job_id'))
+
+# --- Laporan Konsolidasi ---
+REPORT_DEFAULT_DAYS = 30
+
+def _movement_sums(type_column, jumlah_column):
+    return (db.func.sum(db.case((type_column == 'IN', jumlah_column), else_=0)),
+            db.func.sum(db.case((type_column == 'OUT', jumlah_column), else_=0)))
+
+def build_daily_rollups(kantor_id, until=None):
+    # Sama seperti snapshot: hanya hari lengkap (< until) setelah rollup terakhir yang dihitung,
+    # jadi setiap transaksi cukup diagregasi sekali. Rollup tetap disimpan walaupun riwayat dihapus.
+    until = until or _utc_today()
+    _begin_stock_transaction()
+    last_day = db.session.query(db.func.max(DailyRollup.tanggal)).filter(DailyRollup.kantor_id == kantor_id).scalar()
+    if last_day is not None:
+        start = _as_date(last_day) + timedelta(days=1)
+    else:
+        first_timestamp = db.session.query(db.func.min(Transaction.timestamp)).filter(Transaction.kantor_id == kantor_id).scalar()
+        if first_timestamp is None:
+            return 0
+        start = _as_date(first_timestamp)
+    if start >= until:
+        return 0
+    day = db.func.date(Transaction.timestamp)
+    daily = (db.session.query(Transaction.material_id, day, *_movement_sums(Transaction.tipe_transaksi, Transaction.jumlah), db.func.count(Transaction.id))
+             .filter(Transaction.kantor_id == kantor_id, Transaction.timestamp >= _day_start(start), Transaction.timestamp < _day_start(until))
+             .group_by(Transaction.material_id, day).all())
+    rows = [{'material_id': material_id, 'kantor_id': kantor_id, 'tanggal': _as_date(tanggal), 'qty_in': qty_in or 0, 'qty_out': qty_out or 0,
+             'n_transaksi': n_transaksi} for material_id, tanggal, qty_in, qty_out, n_transaksi in daily]
+    _insert_ignore(DailyRollup.__table__, rows)
+    return len(rows)
+
+def _days_of_cover(jumlah, velocity):
+    return round(jumlah / velocity, 1) if velocity else None
+
+def consolidated_report(start, end, kantor_id=None):
+    # Hanya membaca: rollup dibangun scheduler/job snapshot. Per kantor, hari sampai rollup terakhirnya
+    # dibaca dari DailyRollup dan hari sesudahnya (termasuk hari ini, UTC) langsung dari Transaction.
+    kantor_rows = Kantor.query.order_by(Kantor.nama_kantor).all()
+    kantor_ids = [kantor.id for kantor in kantor_rows if kantor_id in (None, kantor.id)]
+    days = (end - start).days + 1
+    last_rolled = dict(db.session.query(DailyRollup.kantor_id, db.func.max(DailyRollup.tanggal))
+                       .filter(DailyRollup.kantor_id.in_(kantor_ids)).group_by(DailyRollup.kantor_id).all())
+    live_from = {office_id: max(start, _as_date(last_rolled[office_id]) + timedelta(days=1)) if office_id in last_rolled else start
+                 for office_id in kantor_ids}
+    rolled = (db.session.query(DailyRollup.material_id.label('material_id'), db.func.sum(DailyRollup.qty_in).label('qty_in'),
+                               db.func.sum(DailyRollup.qty_out).label('qty_out'))
+              .filter(DailyRollup.kantor_id.in_(kantor_ids), DailyRollup.tanggal >= start, DailyRollup.tanggal <= end)
+              .group_by(DailyRollup.material_id).subquery())
+    live_in, live_out = _movement_sums(Transaction.tipe_transaksi, Transaction.jumlah)
+    live = (db.session.query(Transaction.material_id.label('material_id'), live_in.label('qty_in'), live_out.label('qty_out'))
+            .filter(db.or_(False, *(db.and_(Transaction.kantor_id == office_id, Transaction.timestamp >= _day_start(day))
+                                    for office_id, day in live_from.items())),
+                    Transaction.timestamp < _day_start(end + timedelta(days=1)))
+            .group_by(Transaction.material_id).subquery())
+    qty_in = db.func.coalesce(rolled.c.qty_in, 0) + db.func.coalesce(live.c.qty_in, 0)
+    qty_out = db.func.coalesce(rolled.c.qty_out, 0) + db.func.coalesce(live.c.qty_out, 0)
+    low_stock = db.case((Material.jumlah < db.func.coalesce(Material.stok_minimum, Kantor.low_stock_threshold), 1), else_=0)
+
+    def with_movements(query):
+        return (query.join(Kantor, Kantor.id == Material.kantor_id).filter(Material.kantor_id.in_(kantor_ids))
+                .outerjoin(rolled, rolled.c.material_id == Material.id).outerjoin(live, live.c.material_id == Material.id))
+
+    per_office = {row[0]: row for row in with_movements(db.session.query(
+        Material.kantor_id, db.func.count(Material.id), db.func.sum(Material.jumlah), db.func.sum(qty_in), db.func.sum(qty_out), db.func.sum(low_stock)))
+        .group_by(Material.kantor_id).all()}
+    offices = []
+    for kantor in kantor_rows:
+        if kantor.id not in kantor_ids:
+            continue
+        _, jumlah_material, total_stok, total_in, total_out, stok_menipis = per_office.get(kantor.id, (kantor.id, 0, 0, 0, 0, 0))
+        velocity = (total_out or 0) / days
+        offices.append({'kantor_id': kantor.id, 'nama_kantor': kantor.nama_kantor, 'kode_kantor': kantor.kode_kantor,
+                        'jumlah_material': jumlah_material, 'total_stok': total_stok or 0, 'qty_in': total_in or 0, 'qty_out': total_out or 0,
+                        'velocity': round(velocity, 2), 'days_of_cover': _days_of_cover(total_stok or 0, velocity), 'stok_menipis': stok_menipis or 0})
+    report = {'start': start.isoformat(), 'end': end.isoformat(), 'hari': days, 'kantor': offices, 'materials': []}
+    if kantor_id is None:
+        return report
+    rows = with_movements(db.session.query(Material.id, Material.id_barang, Material.nama_material, Material.jumlah, Satuan.nama,
+                                           qty_in.label('qty_in'), qty_out.label('qty_out'), low_stock)
+                          .outerjoin(Satuan, Satuan.id == Material.satuan_id)).all()
+    for material_id, id_barang, nama_material, jumlah, satuan, material_in, material_out, menipis in rows:
+        velocity = material_out / days
+        report['materials'].append({'material_id': material_id, 'id_barang': id_barang, 'nama_material': nama_material, 'satuan': satuan,
+                                    'jumlah': jumlah, 'qty_in': material_in, 'qty_out': material_out, 'velocity': round(velocity, 2),
+                                    'days_of_cover': _days_of_cover(jumlah, velocity), 'stok_menipis': bool(menipis)})
+    # Material yang paling cepat habis di atas; material tanpa pemakaian di akhir.
+    report['materials'].sort(key=lambda row: (row['days_of_cover'] is None, row['days_of_cover'] or 0, row['nama_material']))
+    return report
+
+@app.route('/admin/reports')
+@login_required
+@admin_required
+def consolidated_reports():
+    end = _parse_date(request.args.get('end'))
+    end = end.date() if end else _utc_today()
+    start = _parse_date(request.args.get('start'))
+    start = start.date() if start else end - timedelta(days=REPORT_DEFAULT_DAYS - 1)
+    if start > end:
+        flash('Tanggal awal tidak boleh setelah tanggal akhir.', 'danger')
+        start = end - timedelta(days=REPORT_DEFAULT_DAYS - 1)
+    kantor_id = request.args.get('kantor_id', type=int)
+    report = consolidated_report(start, end, kantor_id)
+    if request.args.get('format') == 'json':
+        return jsonify(report)
+    return render_template('admin_reports.html', report=report, kantor_id=kantor_id)
+
+# --- Sinkronisasi Cabang ↔ Pusat ---
+# Pusat adalah pemilik data master (kantor, satuan, material, user, izin). Cabang menyalinnya dengan
+# id yang sama, menulis pergerakan stok ke SQLite lokal + SyncOutbox, lalu worker sync mengirim
+# outbox ke pusat dan menarik perubahan master secara inkremental berdasarkan SyncChange.seq.
+SYNC_ENTITIES = {'kantor': Kantor.__table__, 'satuan': Satuan.__table__, 'material': Material.__table__, 'user': User.__table__}
+_sync_lock = threading.Lock()
+_sync_engines = {}
+
+def central_only(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if app.config['SYNC_REMOTE_URL']:
+            flash('Data master hanya bisa diubah di server pusat, perubahannya akan tersinkron otomatis ke cabang ini.', 'warning')
+            return redirect(url_for('dashboard'))
+        return f(*args, **kwargs)
+    return decorated_function
+
+def record_sync_changes(entitas, ids, kantor_id=None, connection=None):
+    # connection diisi saat worker cabang menulis langsung ke database pusat.
+    if not ids or (connection is None and not app.config['SYNC_RECORD_CHANGES']):
+        return
+    (connection or db.session).execute(SyncChange.__table__.insert(),
+                                       [{'entitas': entitas, 'entitas_id': entitas_id, 'kantor_id': kantor_id} for entitas_id in ids])
+
+def prune_sync_changes():
+    # Cabang melaporkan seq terakhirnya sebagai SyncState branch_seq:<kantor_id> di pusat. Batas pangkas
+    # dicatat di sync_change_pruned_seq; cabang yang tertinggal di bawahnya mengambil ulang salinan penuh.
+    if not app.config['SYNC_RECORD_CHANGES']:
+        return 0
+    floor = 0
+    if app.config['SYNC_CHANGE_RETENTION_DAYS']:
+        cutoff = datetime.utcnow() - timedelta(days=app.config['SYNC_CHANGE_RETENTION_DAYS'])
+        floor = db.session.query(db.func.max(SyncChange.seq)).filter(SyncChange.created_at < cutoff).scalar() or 0
+    confirmed = [int(nilai) for (nilai,) in db.session.query(SyncState.nilai).filter(SyncState.nama.like('branch_seq:%'))]
+    if confirmed:
+        floor = max(floor, min(confirmed))
+    # Baris terbaru selalu disisakan: tanpa itu SQLite memakai ulang seq, dan salinan awal cabang
+    # (seq = max) akan berada di bawah batas pangkas.
+    floor = min(floor, (db.session.query(db.func.max(SyncChange.seq)).scalar() or 0) - 1)
+    if floor <= int(_sync_state('sync_change_pruned_seq', 0)):
+        return 0
+    deleted = SyncChange.query.filter(SyncChange.seq <= floor).delete(synchronize_session=False)
+    _set_sync_state('sync_change_pruned_seq', floor)
+    db.session.commit()
+    return deleted
+
+def queue_sync_movement(kantor_id, user_id, tipe_transaksi, lines, sumber):
+    payload = {'kantor_id': kantor_id, 'user_id': user_id, 'tipe_transaksi': tipe_transaksi, 'sumber': sumber,
+               'timestamp': datetime.utcnow().replace(microsecond=0).isoformat(), 'lines': lines}
+    db.session.add(SyncOutbox(uuid=uuid.uuid4().hex, jenis='movement', payload=json.dumps(payload)))
+
+def _sync_engine():
+    url = app.config['SYNC_REMOTE_URL']
+    if url not in _sync_engines:
+        _sync_engines[url] = create_engine(url, pool_pre_ping=True)
+    return _sync_engines[url]
+
+def _sync_state(nama, default=None):
+    state = db.session.get(SyncState, nama)
+    return state.nilai if state else default
+
+def _set_sync_state(nama, nilai):
+    db.session.merge(SyncState(nama=nama, nilai=str(nilai)))
+
+def _movement_deltas(payload):
+    sign = 1 if payload['tipe_transaksi'] == 'IN' else -1
+    deltas = {}
+    for material_id, jumlah in payload['lines']:
+        deltas[material_id] = deltas.get(material_id, 0) + sign * jumlah
+    return deltas
+
+def _apply_remote_movement(connection, payload):
+    # Dijalankan di koneksi pusat. Stok diperiksa sebelum menulis: baris untuk material yang tidak ada
+    # atau stoknya tidak cukup ditolak, baris lain tetap diterapkan. Mengembalikan
+    # (status, pesan, baris_ditolak) dengan status applied, partial atau conflict (semua ditolak).
+    material = Material.__table__
+    deltas = _movement_deltas(payload)
+    query = (db.select(material.c.id, material.c.nama_material, material.c.jumlah)
+             .where(material.c.id.in_(list(deltas)), material.c.kantor_id == payload['kantor_id']))
+    if connection.dialect.name == 'postgresql':
+        query = query.with_for_update()
+    current = {row.id: row for row in connection.execute(query)}
+    # Diterapkan atau ditolak, cabang perlu menarik ulang stok material ini dari pusat.
+    record_sync_changes('material', list(deltas), payload['kantor_id'], connection)
+    missing = [material_id for material_id in deltas if material_id not in current]
+    shortages = [(current[material_id].nama_material, current[material_id].jumlah, -delta)
+                 for material_id, delta in deltas.items() if material_id in current and current[material_id].jumlah + delta < 0]
+    pesan = []
+    if missing:
+        pesan.append(f'Material dengan id {missing} tidak ada di pusat.')
+    if shortages:
+        pesan.append(f'Stok pusat tidak cukup: {StockError(shortages)}')
+    deltas = {material_id: delta for material_id, delta in deltas.items()
+              if material_id in current and current[material_id].jumlah + delta >= 0}
+    if deltas:
+        delta_case = db.case(deltas, value=material.c.id)
+        updated = connection.execute(material.update()
+                                     .where(material.c.id.in_(list(deltas)), material.c.jumlah + delta_case >= 0)
+                                     .values(jumlah=material.c.jumlah + delta_case)).rowcount
+        if updated != len(deltas):
+            raise RuntimeError('Stok pusat berubah selama sinkronisasi, batch akan dicoba lagi.')
+        timestamp = datetime.fromisoformat(payload['timestamp'])
+        connection.execute(Transaction.__table__.insert(), [
+            {'material_id': material_id, 'tipe_transaksi': payload['tipe_transaksi'], 'jumlah': jumlah, 'sumber': payload['sumber'],
+             'user_id': payload['user_id'], 'kantor_id': payload['kantor_id'], 'timestamp': timestamp}
+            for material_id, jumlah in payload['lines'] if material_id in deltas])
+    rejected = [[material_id, jumlah] for material_id, jumlah in payload['lines'] if material_id not in deltas]
+    if not rejected:
+        return 'applied', None, []
+    return ('partial' if deltas else 'conflict'), ' '.join(pesan)[:500], rejected
+
+def _reverse_local_movement(entry, payload, rejected):
+    # Baris yang ditolak pusat sudah tercatat di cabang. Dibatalkan dengan transaksi kebalikan supaya
+    # riwayat lokal tetap cocok dengan stok hasil tarikan dari pusat (yang tidak memuat baris ini).
+    tipe_transaksi = 'OUT' if payload['tipe_transaksi'] == 'IN' else 'IN'
+    local_ids = {material_id for batch in _batched(list({material_id for material_id, _ in rejected}), IMPORT_LOOKUP_BATCH)
+                 for (material_id,) in db.session.query(Material.id).filter(Material.id.in_(batch))}
+    lines = [(material_id, jumlah) for material_id, jumlah in rejected if material_id in local_ids]
+    if not lines:
+        return
+    deltas = _movement_deltas({'tipe_transaksi': tipe_transaksi, 'lines': lines})
+    delta_case = db.case(deltas, value=Material.id)
+    Material.query.filter(Material.id.in_(list(deltas))).update({Material.jumlah: Material.jumlah + delta_case}, synchronize_session=False)
+    db.session.execute(Transaction.__table__.insert(), [
+        {'material_id': material_id, 'tipe_transaksi': tipe_transaksi, 'jumlah': jumlah, 'sumber': f'Batal sinkronisasi {entry.uuid[:8]}',
+         'user_id': payload['user_id'], 'kantor_id': payload['kantor_id']}
+        for material_id, jumlah in lines])
+    _dashboard_cache.pop(payload['kantor_id'])
+
+def _sync_push(remote):
+    entries = SyncOutbox.query.filter_by(status='pending').order_by(SyncOutbox.id).limit(app.config['SYNC_BATCH']).all()
+    if not entries:
+        return 0, 0
+    receipt = SyncReceipt.__table__
+    payloads = {entry.uuid: json.loads(entry.payload) for entry in entries}
+    results = {}
+    with remote.begin() as connection:
+        for row in connection.execute(db.select(receipt).where(receipt.c.uuid.in_(list(payloads)))):
+            # Receipt lama tanpa kolom ditolak: konflik berarti seluruh kiriman ditolak.
+            rejected = json.loads(row.ditolak) if row.ditolak else (payloads[row.uuid]['lines'] if row.status != 'applied' else [])
+            results[row.uuid] = (row.status, row.pesan, rejected)
+        for entry in entries:
+            if entry.uuid in results:
+                continue
+            status, pesan, rejected = results[entry.uuid] = _apply_remote_movement(connection, payloads[entry.uuid])
+            connection.execute(receipt.insert(), {'uuid': entry.uuid, 'status': status, 'pesan': pesan,
+                                                  'ditolak': json.dumps(rejected) if rejected else None})
+    # Bila proses berhenti sebelum commit lokal di bawah, kiriman ulang menemukan receipt-nya dan tidak diterapkan lagi;
+    # pembatalan lokal ikut commit yang sama, jadi hanya terjadi sekali.
+    _begin_stock_transaction()
+    now = datetime.utcnow()
+    for entry in entries:
+        _, entry.pesan, rejected = results[entry.uuid]
+        entry.status = 'conflict' if rejected else 'sent'
+        entry.ditolak = json.dumps(rejected) if rejected else None
+        entry.sent_at = now
+        if rejected:
+            _reverse_local_movement(entry, payloads[entry.uuid], rejected)
+    db.session.commit()
+    return len(entries), sum(1 for entry in entries if entry.status == 'conflict')
+
+def _fetch_remote(connection, ids):
+    fetched = {}
+    for entitas, entity_ids in ids.items():
+        table = user_material_permissions if entitas == 'permissions' else SYNC_ENTITIES[entitas]
+        key = table.c.user_id if entitas == 'permissions' else table.c.id
+        fetched[entitas] = [dict(row._mapping) for batch in _batched(list(entity_ids), IMPORT_LOOKUP_BATCH)
+                            for row in connection.execute(db.select(table).where(key.in_(batch)))]
+    return fetched
+
+def _upsert_local(table, rows):
+    if not rows:
+        return
+    existing = {row_id for batch in _batched([row['id'] for row in rows], IMPORT_LOOKUP_BATCH)
+                for (row_id,) in db.session.execute(db.select(table.c.id).where(table.c.id.in_(batch)))}
+    columns = [column for column in rows[0] if column != 'id']
+    updates = [{'b_id': row['id'], **{f'b_{column}': row[column] for column in columns}} for row in rows if row['id'] in existing]
+    if updates:
+        db.session.execute(table.update().where(table.c.id == db.bindparam('b_id'))
+                           .values({column: db.bindparam(f'b_{column}') for column in columns}), updates)
+    inserts = [row for row in rows if row['id'] not in existing]
+    if inserts:
+        db.session.execute(table.insert(), inserts)
+
+def _delete_local(entitas, ids):
+    # Material/user yang sudah punya transaksi lokal (juga yang sudah diarsipkan) tidak bisa dihapus; dibiarkan dan dicatat.
+    column = Transaction.material_id if entitas == 'material' else Transaction.user_id
+    used = {row_id for (row_id,) in db.session.query(column).filter(column.in_(ids)).distinct()}
+    used |= archived_ids(column.name, [row_id for row_id in ids if row_id not in used])
+    if used:
+        app.logger.warning('Sinkronisasi: %s %s dihapus di pusat tetapi masih punya transaksi lokal.', entitas, sorted(used))
+    ids = [row_id for row_id in ids if row_id not in used]
+    if not ids:
+        return
+    permissions = user_material_permissions.c
+    if entitas == 'material':
+        db.session.execute(user_material_permissions.delete().where(permissions.material_id.in_(ids)))
+        StockSnapshot.query.filter(StockSnapshot.material_id.in_(ids)).delete(synchronize_session=False)
+        DailyRollup.query.filter(DailyRollup.material_id.in_(ids)).delete(synchronize_session=False)
+    else:
+        db.session.execute(user_material_permissions.delete().where(permissions.user_id.in_(ids)))
+        ApiToken.query.filter(ApiToken.user_id.in_(ids)).delete(synchronize_session=False)
+    table = SYNC_ENTITIES[entitas]
+    db.session.execute(table.delete().where(table.c.id.in_(ids)))
+
+def _apply_pulled(fetched, ids):
+    # Stok lokal = stok pusat + pergerakan lokal yang belum terkirim. BEGIN IMMEDIATE mencegah
+    # transaksi baru menyelip di antara membaca outbox dan menulis stok.
+    _begin_stock_transaction()
+    pending = {}
+    for (payload,) in db.session.query(SyncOutbox.payload).filter_by(status='pending'):
+        for material_id, delta in _movement_deltas(json.loads(payload)).items():
+            pending[material_id] = pending.get(material_id, 0) + delta
+    for entitas, table in SYNC_ENTITIES.items():
+        rows = fetched.get(entitas, [])
+        if entitas == 'material':
+            rows = [{**row, 'jumlah': row['jumlah'] + pending.get(row['id'], 0)} for row in rows]
+        _upsert_local(table, rows)
+    if 'permissions' in ids:
+        for batch in _batched(list(ids['permissions']), IMPORT_LOOKUP_BATCH):
+            db.session.execute(user_material_permissions.delete().where(user_material_permissions.c.user_id.in_(batch)))
+        if fetched['permissions']:
+            db.session.execute(user_material_permissions.insert(), fetched['permissions'])
+    for entitas in ('user', 'material'):
+        gone = set(ids.get(entitas, ())) - {row['id'] for row in fetched.get(entitas, [])}
+        if gone:
+            _delete_local(entitas, list(gone))
+    _dashboard_cache.clear()
+    _permission_cache.clear()
+
+def _sync_bootstrap(remote):
+    # Salinan awal penuh untuk kantor cabang; seq dibaca lebih dulu supaya perubahan selama
+    # penyalinan ikut ditarik ulang pada putaran berikutnya.
+    kantor, change = Kantor.__table__, SyncChange.__table__
+    with remote.connect() as connection:
+        last_seq = connection.execute(db.select(db.func.max(change.c.seq))).scalar() or 0
+        kantor_id = connection.execute(db.select(kantor.c.id).where(kantor.c.kode_kantor == app.config['SYNC_KANTOR'])).scalar()
+        if kantor_id is None:
+            raise RuntimeError(f"Kantor dengan kode {app.config['SYNC_KANTOR']!r} tidak ditemukan di database pusat.")
+        ids = {'kantor': [kantor_id], 'satuan': connection.execute(db.select(Satuan.__table__.c.id)).scalars().all()}
+        for entitas in ('material', 'user'):
+            table = SYNC_ENTITIES[entitas]
+            ids[entitas] = connection.execute(db.select(table.c.id).where(table.c.kantor_id == kantor_id)).scalars().all()
+        ids['permissions'] = ids['user']
+        fetched = _fetch_remote(connection, ids)
+    if _sync_state('kantor_id') is not None:
+        # Ambil ulang setelah log pusat dipangkas: material/user lokal yang sudah tidak ada di pusat ikut dihapus.
+        for entitas in ('material', 'user'):
+            table = SYNC_ENTITIES[entitas]
+            ids[entitas] = set(ids[entitas]) | set(db.session.execute(db.select(table.c.id).where(table.c.kantor_id == kantor_id)).scalars())
+        ids['permissions'] = ids['user']
+    _apply_pulled(fetched, ids)
+    _set_sync_state('kantor_id', kantor_id)
+    _set_sync_state('last_seq', last_seq)
+    db.session.commit()
+
+def _sync_pull(remote, kantor_id):
+    change = SyncChange.__table__
+    last_seq = int(_sync_state('last_seq', 0))
+    with remote.connect() as connection:
+        changes = connection.execute(db.select(change.c.seq, change.c.entitas, change.c.entitas_id)
+                                     .where(change.c.seq > last_seq, db.or_(change.c.kantor_id.is_(None), change.c.kantor_id == kantor_id))
+                                     .order_by(change.c.seq).limit(app.config['SYNC_BATCH'])).all()
+        if not changes:
+            return 0
+        ids = {}
+        for row in changes:
+            ids.setdefault(row.entitas, set()).add(row.entitas_id)
+        fetched = _fetch_remote(connection, ids)
+    _apply_pulled(fetched, ids)
+    _set_sync_state('last_seq', changes[-1].seq)
+    db.session.commit()
+    return len(changes)
+
+def _remote_sync_state(connection, nama):
+    state = SyncState.__table__
+    return connection.execute(db.select(state.c.nilai).where(state.c.nama == nama)).scalar()
+
+def _report_sync_seq(remote, kantor_id):
+    # Konfirmasi ke pusat sampai seq mana cabang ini sudah menarik, dasar prune_sync_changes().
+    state = SyncState.__table__
+    nama, nilai = f'branch_seq:{kantor_id}', str(_sync_state('last_seq', 0))
+    with remote.begin() as connection:
+        if _remote_sync_state(connection, nama) == nilai:
+            return
+        if not connection.execute(state.update().where(state.c.nama == nama).values(nilai=nilai)).rowcount:
+            connection.execute(state.insert().values(nama=nama, nilai=nilai))
+
+def sync_once():
+    # Kirim dulu baru tarik, supaya stok hasil tarikan sudah memuat kiriman terbaru cabang ini.
+    with _sync_lock:
+        remote = _sync_engine()
+        if _sync_state('kantor_id') is None:
+            _sync_bootstrap(remote)
+        kantor_id = int(_sync_state('kantor_id'))
+        result = {'pushed': 0, 'conflicts': 0, 'pulled': 0}
+        while True:
+            pushed, conflicts = _sync_push(remote)
+            result['pushed'] += pushed
+            result['conflicts'] += conflicts
+            if pushed < app.config['SYNC_BATCH']:
+                break
+        with remote.connect() as connection:
+            pruned_seq = int(_remote_sync_state(connection, 'sync_change_pruned_seq') or 0)
+        if int(_sync_state('last_seq', 0)) < pruned_seq:
+            app.logger.warning('Log perubahan pusat sudah dipangkas melewati posisi cabang ini; salinan data master diambil ulang.')
+            _sync_bootstrap(remote)
+        while True:
+            pulled = _sync_pull(remote, kantor_id)
+            result['pulled'] += pulled
+            if pulled < app.config['SYNC_BATCH']:
+                break
+        _report_sync_seq(remote, kantor_id)
+        return result
+
+@job_handler('sync')
+def _sync_job(params, kantor_id, progress):
+    return sync_once()
+
+def start_sync_worker():
+    if not app.config['SYNC_REMOTE_URL']:
+        return
+    def loop():
+        while True:
+            with app.app_context():
+                try:
+                    sync_once()
+                except Exception:
+                    db.session.rollback()
+                    app.logger.exception('Sinkronisasi ke pusat gagal, dicoba lagi dalam %s detik.', app.config['SYNC_INTERVAL'])
+            time.sleep(app.config['SYNC_INTERVAL'])
+    threading.Thread(target=loop, daemon=True, name='minty-sync').start()
+
+@app.route('/admin/sync', methods=['GET', 'POST'])
+@login_required
+@admin_required
+def sync_status():
+    if not app.config['SYNC_REMOTE_URL']:
+        flash('Aplikasi ini tidak berjalan dalam mode cabang.', 'info')
+        return redirect(url_for('dashboard'))
+    if request.method == 'POST':
+        if request.form.get('action') in ('retry', 'resolve'):
+            return _resolve_sync_conflict(request.form.get('action'), request.form.get('uuid', ''))
+        job = submit_job('sync', session.get('kantor_id'), session['user_id'], {})
+        flash('Sinkronisasi sedang berjalan di latar belakang.', 'info')
+        return redirect(url_for('sync_status', job_id=job.id))
+    counts = dict(db.session.query(SyncOutbox.status, db.func.count(SyncOutbox.id)).group_by(SyncOutbox.status).all())
+    status = {'pending': counts.get('pending', 0), 'sent': counts.get('sent', 0), 'conflict': counts.get('conflict', 0),
+              'resolved': counts.get('resolved', 0), 'last_seq': _sync_state('last_seq')}
+    conflicts = SyncOutbox.query.filter_by(status='conflict').order_by(SyncOutbox.id.desc()).limit(100).all()
+    if request.args.get('format') == 'json':
+        return jsonify({**status, 'conflicts': [{'uuid': entry.uuid, 'pesan': entry.pesan, 'payload': json.loads(entry.payload),
+                                                 'ditolak': json.loads(entry.ditolak) if entry.ditolak else None,
+                                                 'created_at': entry.created_at.isoformat() if entry.created_at else None} for entry in conflicts]})
+    return render_template('admin_sync.html', status=status, conflicts=conflicts, job_id=request.args.get('job_id'))
+
+def _resolve_sync_conflict(action, entry_uuid):
+    # resolve: pembatalan lokal diterima apa adanya. retry: baris yang ditolak dicatat ulang sebagai
+    # pergerakan baru (cek stok lokal + outbox baru), misalnya setelah stok pusat dikoreksi.
+    entry = SyncOutbox.query.filter_by(uuid=entry_uuid, status='conflict').first_or_404()
+    payload = json.loads(entry.payload)
+    if action == 'retry':
+        if entry.ditolak is None:
+            # Konflik sebelum ada pembatalan lokal: baris lokalnya masih ada, cukup dikirim ulang dengan uuid baru.
+            entry.uuid, entry.status, entry.pesan = uuid.uuid4().hex, 'pending', None
+        else:
+            try:
+                changes = apply_stock_movements(payload['kantor_id'], payload['user_id'], payload['tipe_transaksi'],
+                                                [tuple(line) for line in json.loads(entry.ditolak)], payload['sumber'])
+            except StockError as e:
+                db.session.rollback()
+                flash(f'Tidak bisa mengirim ulang: {e}', 'danger')
+                return redirect(url_for('sync_status'))
+            entry.status = 'resolved'
+        db.session.commit()
+        if entry.status == 'resolved':
+            dashboard_stock_changed(payload['kantor_id'], changes, new_transaction=True)
+        flash('Pergerakan yang ditolak dikirim ulang ke pusat.', 'success')
+    else:
+        entry.status = 'resolved'
+        db.session.commit()
+        flash('Konflik sinkronisasi ditandai selesai.', 'success')
+    return redirect(url_for('sync_status'))
+
+# --- API JSON v1 ---
+# Token dibuat admin dan bertindak sebagai user pemiliknya (kantor, role, izin material).
+# Hanya hash SHA-256 token yang disimpan.
+API_MAX_LINES = 1000
+# Batas kolom INTEGER: angka yang lebih besar gagal di driver (OverflowError/DataError), bukan 422.
+API_MAX_JUMLAH = 2 ** 31 - 1
+API_GZIP_MIN_BYTES = 1024
+
+def _hash_api_token(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def _api_error(status, pesan, **extra):
+    response = jsonify({'error': pesan, **extra})
+    response.status_code = status
+    return response
+
+def _api_response(payload):
+    # ETag lemah dari isi JSON; klien yang mengirim If-None-Match dengan nilai yang sama mendapat 304.
+    response = jsonify(payload)
+    response.add_etag(weak=True)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request)
+
+def api_token_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+        user = None
+        if scheme.lower() == 'bearer' and token:
+            user = (User.query.options(joinedload(User.kantor)).join(ApiToken, ApiToken.user_id == User.id)
+                    .filter(ApiToken.token_hash == _hash_api_token(token.strip())).first())
+        if user is None:
+            response = _api_error(401, 'Token API tidak valid.')
+            response.headers['WWW-Authenticate'] = 'Bearer'
+            return response
+        g.api_user = user
+        return f(*args, **kwargs)
+    return decorated_function
+
+def _api_material_query(user):
+    query = Material.query.options(joinedload(Material.satuan)).filter(Material.kantor_id == user.kantor_id)
+    if user.role != 'admin':
+        query = query.filter(Material.id.in_(permitted_material_ids(user.id)))
+    return query
+
+def _api_material(material):
+    return {'id_barang': material.id_barang, 'nama_material': material.nama_material, 'jumlah': material.jumlah,
+            'satuan': material.satuan.nama if material.satuan else None, 'stok_minimum': material.stok_minimum}
+
+@app.after_request
+def _compress_api_response(response):
+    if (not request.path.startswith('/api/') or response.direct_passthrough or response.status_code not in (200, 201)
+            or 'Content-Encoding' in response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    if 'gzip' not in request.headers.get('Accept-Encoding', ''):
+        return response
+    data = response.get_data()
+    if len(data) >= API_GZIP_MIN_BYTES:
+        response.set_data(gzip.compress(data, compresslevel=6))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+@app.route('/api/v1/materials/<path:id_barang>')
+@api_token_required
+def api_material(id_barang):
+    material = _api_material_query(g.api_user).filter(Material.id_barang == id_barang).first()
+    if material is None:
+        return _api_error(404, f'Material "{id_barang}" tidak ditemukan.')
+    return _api_response(_api_material(material))
+
+@app.route('/api/v1/stock')
+@api_token_required
+def api_stock():
+    # ?id_barang=A&id_barang=B atau ?id_barang=A,B; tanpa parameter: semua material yang boleh diakses.
+    id_barang = [value.strip() for values in request.args.getlist('id_barang') for value in values.split(',') if value.strip()]
+    query = _api_material_query(g.api_user)
+    if id_barang:
+        query = query.filter(Material.id_barang.in_(id_barang))
+    materials = query.order_by(Material.nama_material).all()
+    return _api_response({'kantor_id': g.api_user.kantor_id, 'materials': [_api_material(material) for material in materials]})
+
+@app.route('/api/v1/history')
+@api_token_required
+def api_history():
+    user = g.api_user
+    filters = _history_filters(request.args)
+    per_page = _history_per_page()
+    query = _filter_history(Transaction.query.options(joinedload(Transaction.material), joinedload(Transaction.user)), user.kantor_id, filters)
+    transactions, next_cursor = history_page(query, user.kantor_id, filters, _decode_cursor(request.args.get('cursor')), per_page)
+    return _api_response({'transaksi': [{'id': transaction.id, 'timestamp': transaction.timestamp.isoformat(), 'tipe_transaksi': transaction.tipe_transaksi,
+                                         'id_barang': transaction.material.id_barang, 'nama_material': transaction.material.nama_material,
+                                         'jumlah': transaction.jumlah, 'sumber': transaction.sumber, 'username': transaction.user.username,
+                                         'arsip': getattr(transaction, 'arsip', False)} for transaction in transactions],
+                          'next_cursor': next_cursor})
+
+@app.route('/api/v1/movements', methods=['POST'])
+@api_token_required
+def api_movements():
+    # Body: {"tipe_transaksi": "IN"|"OUT", "sumber": "...", "lines": [{"id_barang": "...", "jumlah": 3, "tipe_transaksi": opsional}]}.
+    # Semua baris diproses dalam satu transaksi database: satu baris gagal, tidak ada yang disimpan.
+    user = g.api_user
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('lines'), list) or not data['lines']:
+        return _api_error(400, 'Body harus berupa JSON dengan daftar "lines".')
+    if len(data['lines']) > API_MAX_LINES:
+        return _api_error(400, f'Maksimal {API_MAX_LINES} baris per request.')
+    parsed, errors = [], []
+    for index, line in enumerate(data['lines']):
+        if not isinstance(line, dict):
+            errors.append({'index': index, 'pesan': 'Baris harus berupa objek JSON.'})
+            continue
+        tipe, jumlah = line.get('tipe_transaksi', data.get('tipe_transaksi')), line.get('jumlah')
+        if tipe not in ('IN', 'OUT'):
+            errors.append({'index': index, 'pesan': 'tipe_transaksi harus IN atau OUT.'})
+        elif not isinstance(jumlah, int) or isinstance(jumlah, bool) or not 0 < jumlah <= API_MAX_JUMLAH:
+            errors.append({'index': index, 'pesan': f'jumlah harus bilangan bulat antara 1 dan {API_MAX_JUMLAH}.'})
+        else:
+            parsed.append((index, tipe, str(line.get('id_barang', '')), jumlah))
+    material_ids = {}
+    for ids in _batched(list({id_barang for _, _, id_barang, _ in parsed}), IMPORT_LOOKUP_BATCH):
+        material_ids.update(db.session.query(Material.id_barang, Material.id).filter(Material.kantor_id == user.kantor_id, Material.id_barang.in_(ids)).all())
+    allowed = None if user.role == 'admin' else set(permitted_material_ids(user.id))
+    for index, _, id_barang, _ in parsed:
+        material_id = material_ids.get(id_barang)
+        if material_id is None or (allowed is not None and material_id not in allowed):
+            errors.append({'index': index, 'id_barang': id_barang, 'pesan': 'Material tidak ditemukan atau tidak diizinkan untuk user ini.'})
+    if errors:
+        return _api_error(422, 'Ada baris yang tidak valid, tidak ada yang diproses.', errors=sorted(errors, key=lambda error: error['index']))
+    lines = {'IN': [], 'OUT': []}
+    for _, tipe, id_barang, jumlah in parsed:
+        lines[tipe].append((material_ids[id_barang], jumlah))
+    sumber = str(data.get('sumber') or 'API')[:100]
+    try:
+        changes = []
+        # IN diproses lebih dulu sehingga barang yang masuk di batch yang sama bisa langsung dikeluarkan.
+        for tipe in ('IN', 'OUT'):
+            changes += apply_stock_movements(user.kantor_id, user.id, tipe, lines[tipe], sumber)
+        db.session.commit()
+    except StockError as e:
+        db.session.rollback()
+        return _api_error(409, 'Stok tidak cukup, tidak ada yang diproses.',
+                          shortages=[{'nama_material': nama, 'stok': stok, 'diminta': diminta} for nama, stok, diminta in e.shortages])
+    dashboard_stock_changed(user.kantor_id, changes, new_transaction=bool(changes))
+    response = jsonify({'diproses': len(parsed), 'stok': {material.id_barang: material.jumlah for material, _ in changes}})
+    response.status_code = 201
+    return response
+
+@app.route('/admin/api-tokens', methods=['GET', 'POST'])
+@login_required
+@admin_required
+def manage_api_tokens():
+    if request.method == 'POST':
+        user = db.session.get(User, request.form.get('user_id', session['user_id'], type=int))
+        if user is None:
+            flash('User tidak ditemukan.', 'danger')
+            return redirect(url_for('manage_api_tokens'))
+        token = secrets.token_urlsafe(32)
+        db.session.add(ApiToken(nama=request.form.get('nama') or 'API', token_hash=_hash_api_token(token), user_id=user.id))
+        db.session.commit()
+        flash(f'Token API untuk "{user.username}": {token} (simpan sekarang, token tidak akan ditampilkan lagi).', 'success')
+        return redirect(url_for('manage_api_tokens'))
+    tokens = ApiToken.query.options(joinedload(ApiToken.user)).order_by(ApiToken.created_at.desc()).all()
+    users = User.query.order_by(User.username).all()
+    return render_template('admin_api_tokens.html', tokens=tokens, users=users)
+
+@app.route('/admin/api-tokens/delete/<int:token_id>', methods=['POST'])
+@login_required
+@admin_required
+def delete_api_token(token_id):
+    token = ApiToken.query.get_or_404(token_id)
+    db.session.delete(token)
+    db.session.commit()
+    flash(f'Token API "{token.nama}" telah dicabut.', 'success')
+    return redirect(url_for('manage_api_tokens'))
+
 # --- Rute Admin ---
 @app.route('/admin/materials')
 @login_required
@@ -208,6 +2323,7 @@ def manage_materials():
 @app.route('/admin/materials/add', methods=['GET', 'POST'])
 @login_required
 @admin_required
+@central_only
 def add_material():
     user_kantor_id = session.get('kantor_id')
     if request.method == 'POST':
@@ -215,9 +2331,12 @@ def add_material():
         if Material.query.filter_by(id_barang=id_brg, kantor_id=user_kantor_id).first():
             flash(f'Gagal! ID Barang "{id_brg}" sudah ada di kantor ini.', 'danger')
             return redirect(url_for('add_material'))
-        new_material = Material(id_barang=id_brg, nama_material=request.form.get('nama_material'), jumlah=request.form.get('jumlah'), satuan_id=request.form.get('satuan_id'), kantor_id=user_kantor_id)
+        new_material = Material(id_barang=id_brg, nama_material=request.form.get('nama_material'), jumlah=request.form.get('jumlah'), satuan_id=request.form.get('satuan_id'), stok_minimum=request.form.get('stok_minimum', type=int), kantor_id=user_kantor_id)
         db.session.add(new_material)
+        db.session.flush()
+        record_sync_changes('material', [new_material.id], user_kantor_id)
         db.session.commit()
+        dashboard_stock_changed(user_kantor_id, [(new_material, new_material.jumlah)], types_delta=1)
         flash('Material baru berhasil ditambahkan!', 'success')
         return redirect(url_for('manage_materials'))
     satuans = Satuan.query.all()
@@ -226,13 +2345,21 @@ def add_material():
 @app.route('/admin/materials/edit/<int:material_id>', methods=['GET', 'POST'])
 @login_required
 @admin_required
+@central_only
 def edit_material(material_id):
     material = Material.query.filter_by(id=material_id, kantor_id=session.get('kantor_id')).first_or_404()
     if request.method == 'POST':
+        jumlah_lama, nama_lama = material.jumlah, material.nama_material
         material.nama_material = request.form.get('nama_material')
         material.jumlah = request.form.get('jumlah')
         material.satuan_id = request.form.get('satuan_id')
+        if 'stok_minimum' in request.form:
+            material.stok_minimum = request.form.get('stok_minimum', type=int)
+        record_sync_changes('material', [material.id], material.kantor_id)
         db.session.commit()
+        dashboard_stock_changed(material.kantor_id, [(material, material.jumlah - jumlah_lama)])
+        if material.nama_material != nama_lama:
+            _permission_cache.clear()
         flash('Data material berhasil diperbarui!', 'success')
         return redirect(url_for('manage_materials'))
     satuans = Satuan.query.all()
@@ -241,19 +2368,182 @@ def edit_material(material_id):
 @app.route('/admin/materials/delete/<int:material_id>', methods=['POST'])
 @login_required
 @admin_required
+@central_only
 def delete_material(material_id):
     material = Material.query.filter_by(id=material_id, kantor_id=session.get('kantor_id')).first_or_404()
-    if material.transactions:
+    if material.transactions or archived_ids('material_id', [material.id], material.kantor_id):
         flash('Material tidak bisa dihapus karena sudah memiliki riwayat transaksi.', 'danger')
         return redirect(url_for('manage_materials'))
+    StockSnapshot.query.filter_by(material_id=material.id).delete()
+    DailyRollup.query.filter_by(material_id=material.id).delete()
+    record_sync_changes('material', [material.id], material.kantor_id)
     db.session.delete(material)
     db.session.commit()
+    dashboard_stock_changed(session.get('kantor_id'), [(material, -material.jumlah)], types_delta=-1, deleted=True)
+    _permission_cache.clear()
     flash('Material berhasil dihapus.', 'success')
     return redirect(url_for('manage_materials'))
 
+# --- Impor Excel ---
+IMPORT_COLUMNS = ['id_barang', 'nama_material', 'jumlah', 'satuan']
+IMPORT_LOOKUP_BATCH = 500
+
+class ImportColumnsError(ValueError):
+    pass
+
+def _normalize_header(columns):
+    return [str(column).lower().replace(' ', '_') if column is not None else '' for column in columns]
+
+def _batched(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+def _open_import(stream):
+    # Workbook kecil dibaca sekaligus oleh pandas; workbook besar dibaca baris demi baris
+    # lewat openpyxl read_only supaya memori tetap sebatas satu chunk.
+    import pandas as pd
+    from openpyxl import load_workbook
+    chunk_rows = app.config['IMPORT_CHUNK_ROWS']
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(0)
+    if size <= app.config['IMPORT_STREAMING_BYTES']:
+        df = pd.read_excel(stream)
+        df.columns = _normalize_header(df.columns)
+        return list(df.columns), len(df), (df.iloc[start:start + chunk_rows] for start in range(0, len(df), chunk_rows))
+    workbook = load_workbook(stream, read_only=True, data_only=True)
+    total_rows = max((workbook.active.max_row or 1) - 1, 0)
+    rows = workbook.active.iter_rows(values_only=True)
+    header = _normalize_header(next(rows, ()))
+
+    def chunks():
+        try:
+            buffer, offset = [], 0
+            for row in rows:
+                buffer.append(tuple(row[:len(header)]) + (None,) * (len(header) - len(row)))
+                if len(buffer) == chunk_rows:
+                    yield pd.DataFrame.from_records(buffer, columns=header, index=range(offset, offset + len(buffer)))
+                    offset += len(buffer)
+                    buffer = []
+            if buffer:
+                yield pd.DataFrame.from_records(buffer, columns=header, index=range(offset, offset + len(buffer)))
+        finally:
+            workbook.close()
+    return header, total_rows, chunks()
+
+def _clean_text(series):
+    import pandas as pd
+    if pd.api.types.is_float_dtype(series):
+        # Kolom angka yang berisi sel kosong dibaca pandas sebagai float: 1001.0 -> "1001".
+        whole = series.notna() & (series % 1 == 0)
+        series = series.astype(object).where(~whole, series[whole].astype('int64'))
+    text = series.astype('string').str.strip()
+    return text.mask(text == '')
+
+def _normalize_import_chunk(df):
+    import pandas as pd
+    df = df[IMPORT_COLUMNS]
+    jumlah = pd.to_numeric(df['jumlah'], errors='coerce')
+    chunk = pd.DataFrame({
+        'baris': df.index + 2,
+        'id_barang': _clean_text(df['id_barang']),
+        'nama_material': _clean_text(df['nama_material']),
+        'jumlah': jumlah,
+        'satuan': _clean_text(df['satuan']),
+    })
+    invalid_id = chunk['id_barang'].isna()
+    invalid_jumlah = ~invalid_id & (chunk['jumlah'].isna() | (chunk['jumlah'] % 1 != 0))
+    # Impor hanya menambah stok; jumlah negatif akan membuat stok minus tanpa tercatat sebagai transaksi.
+    negative_jumlah = ~invalid_id & ~invalid_jumlah & (chunk['jumlah'] < 0)
+    errors = [{'baris': int(row.baris), 'id_barang': None, 'pesan': 'ID Barang kosong.'}
+              for row in chunk[invalid_id].itertuples()]
+    errors += [{'baris': int(row.baris), 'id_barang': row.id_barang, 'pesan': 'Jumlah harus berupa angka bulat.'}
+               for row in chunk[invalid_jumlah].itertuples()]
+    errors += [{'baris': int(row.baris), 'id_barang': row.id_barang, 'pesan': 'Jumlah tidak boleh negatif.'}
+               for row in chunk[negative_jumlah].itertuples()]
+    valid = chunk[~invalid_id & ~invalid_jumlah & ~negative_jumlah].astype({'jumlah': 'int64'})
+    return _aggregate_import(valid), errors
+
+def _aggregate_import(frame):
+    aggregated = frame.groupby('id_barang', sort=False).agg(
+        baris=('baris', 'first'), nama_material=('nama_material', 'first'), jumlah=('jumlah', 'sum'), satuan=('satuan', 'first'))
+    return aggregated.reset_index()
+
+def import_materials_from_excel(stream, kantor_id, progress=None):
+    # Tahap 1 membaca dan mengagregasi seluruh workbook tanpa menulis ke database. Tahap 2 baru
+    # menulis, jadi write lock SQLite hanya dipegang sebentar, bukan selama parsing openpyxl.
+    import pandas as pd
+    columns, total_rows, chunks = _open_import(stream)
+    if not all(col in columns for col in IMPORT_COLUMNS):
+        raise ImportColumnsError('File Excel tidak memiliki semua kolom yang dibutuhkan (id_barang, nama_material, jumlah, satuan).')
+    report = {'inserted': 0, 'updated': 0, 'errors': []}
+    parts, processed = [], 0
+    for df in chunks:
+        processed += len(df)
+        if progress:
+            progress(processed * 90 / max(total_rows, processed, 1))
+        chunk, errors = _normalize_import_chunk(df)
+        report['errors'] += errors
+        if not chunk.empty:
+            parts.append(chunk)
+    staged = _aggregate_import(pd.concat(parts)) if len(parts) > 1 else (parts[0] if parts else None)
+    material_table = Material.__table__
+    add_stock = (material_table.update()
+                 .where(material_table.c.id == db.bindparam('b_id'))
+                 .values(jumlah=material_table.c.jumlah + db.bindparam('b_delta')))
+    satuan_ids = dict(db.session.query(Satuan.nama, Satuan.id).all())
+    chunk_rows = app.config['IMPORT_CHUNK_ROWS']
+    for start in range(0, len(staged) if staged is not None else 0, chunk_rows):
+        chunk = staged.iloc[start:start + chunk_rows]
+        existing = {}
+        for ids in _batched(chunk['id_barang'].tolist(), IMPORT_LOOKUP_BATCH):
+            existing.update(db.session.query(Material.id_barang, Material.id)
+                            .filter(Material.kantor_id == kantor_id, Material.id_barang.in_(ids)).all())
+        is_existing = chunk['id_barang'].isin(list(existing))
+        updates = [{'b_id': existing[row.id_barang], 'b_delta': int(row.jumlah)} for row in chunk[is_existing].itertuples()]
+        new_rows = chunk[~is_existing].assign(satuan_id=lambda frame: frame['satuan'].map(satuan_ids))
+        missing_satuan = new_rows['satuan_id'].isna()
+        missing_nama = ~missing_satuan & new_rows['nama_material'].isna()
+        report['errors'] += [{'baris': int(row.baris), 'id_barang': row.id_barang,
+                              'pesan': f"Satuan '{row.satuan}' tidak ditemukan."} for row in new_rows[missing_satuan].itertuples()]
+        report['errors'] += [{'baris': int(row.baris), 'id_barang': row.id_barang,
+                              'pesan': 'Nama material kosong.'} for row in new_rows[missing_nama].itertuples()]
+        inserts = [{'id_barang': row.id_barang, 'nama_material': row.nama_material, 'jumlah': int(row.jumlah),
+                    'satuan_id': int(row.satuan_id), 'kantor_id': kantor_id}
+                   for row in new_rows[~missing_satuan & ~missing_nama].itertuples()]
+        if updates:
+            db.session.execute(add_stock, updates)
+        if inserts:
+            db.session.execute(material_table.insert(), inserts)
+        if app.config['SYNC_RECORD_CHANGES']:
+            changed_ids = [update['b_id'] for update in updates]
+            for ids in _batched([row['id_barang'] for row in inserts], IMPORT_LOOKUP_BATCH):
+                changed_ids += [material_id for (material_id,) in db.session.query(Material.id).filter(Material.kantor_id == kantor_id, Material.id_barang.in_(ids))]
+            record_sync_changes('material', changed_ids, kantor_id)
+        report['updated'] += len(updates)
+        report['inserted'] += len(inserts)
+        if progress:
+            progress(90 + (start + len(chunk)) * 10 / len(staged))
+    report['errors'].sort(key=lambda error: error['baris'])
+    return report
+
+@job_handler('import_materials')
+def _import_materials_job(params, kantor_id, progress):
+    try:
+        with open(params['path'], 'rb') as stream:
+            report = import_materials_from_excel(stream, kantor_id, progress)
+        db.session.commit()
+    finally:
+        os.remove(params['path'])
+    _dashboard_cache.pop(kantor_id)
+    report['errors_total'] = len(report['errors'])
+    report['errors'] = report['errors'][:JOB_MAX_ERRORS]
+    return report
+
 @app.route('/admin/materials/import', methods=['GET', 'POST'])
 @login_required
 @admin_required
+@central_only
 def import_materials():
     if request.method == 'POST':
         if 'excel_file' not in request.files:
@@ -265,39 +2555,20 @@ def import_materials():
             return redirect(request.url)
         if file and file.filename.endswith('.xlsx'):
             try:
-                user_kantor_id = session.get('kantor_id')
-                df = pd.read_excel(file)
-                df.columns = df.columns.str.lower().str.replace(' ', '_')
-                required_columns = ['id_barang', 'nama_material', 'jumlah', 'satuan']
-                if not all(col in df.columns for col in required_columns):
-                    flash('File Excel tidak memiliki semua kolom yang dibutuhkan (id_barang, nama_material, jumlah, satuan).', 'danger')
-                    return redirect(request.url)
-                for index, row in df.iterrows():
-                    id_brg = str(row['id_barang'])
-                    nama = str(row['nama_material'])
-                    jumlah = int(row['jumlah'])
-                    nama_satuan = str(row['satuan'])
-                    existing = Material.query.filter_by(id_barang=id_brg, kantor_id=user_kantor_id).first()
-                    if existing:
-                        existing.jumlah += jumlah
-                        continue
-                    satuan_obj = Satuan.query.filter_by(nama=nama_satuan).first()
-                    if not satuan_obj:
-                        flash(f"Peringatan: Satuan '{nama_satuan}' untuk ID Barang '{id_brg}' tidak ditemukan. Baris ini dilewati.", 'warning')
-                        continue
-                    new_material = Material(id_barang=id_brg, nama_material=nama, jumlah=jumlah, satuan_id=satuan_obj.id, kantor_id=user_kantor_id)
-                    db.session.add(new_material)
-                db.session.commit()
-                flash('Data dari Excel berhasil diimpor!', 'success')
-                return redirect(url_for('manage_materials'))
+                os.makedirs(app.config['JOB_UPLOAD_DIR'], exist_ok=True)
+                path = os.path.join(app.config['JOB_UPLOAD_DIR'], f'{uuid.uuid4().hex}.xlsx')
+                file.save(path)
+                job = submit_job('import_materials', session.get('kantor_id'), session['user_id'], {'path': path, 'filename': file.filename})
             except Exception as e:
                 db.session.rollback()
                 flash(f'Terjadi error saat memproses file: {e}', 'danger')
                 return redirect(request.url)
+            flash('File diterima. Impor sedang diproses di latar belakang.', 'info')
+            return redirect(url_for('import_materials', job_id=job.id))
         else:
             flash('Format file harus .xlsx (Excel)', 'danger')
             return redirect(request.url)
-    return render_template('import_excel.html')
+    return render_template('import_excel.html', job_id=request.args.get('job_id'))
 
 @app.route('/admin/users')
 @login_required
@@ -309,6 +2580,7 @@ def manage_users():
 @app.route('/admin/users/add', methods=['GET', 'POST'])
 @login_required
 @admin_required
+@central_only
 def add_user():
     if request.method == 'POST':
         username = request.form.get('username')
@@ -319,9 +2591,15 @@ def add_user():
         if User.query.filter_by(username=username).first():
             flash(f'Username "{username}" sudah digunakan.', 'danger')
             return redirect(url_for('add_user'))
-        hashed_password = generate_password_hash(request.form.get('password'), method='pbkdf2:sha256')
+        try:
+            hashed_password = hash_password(request.form.get('password'))
+        except PasswordBusyError:
+            flash('Server sedang sibuk, silakan coba lagi sebentar.', 'warning')
+            return redirect(url_for('add_user'))
         new_user = User(username=username, password=hashed_password, role=request.form.get('role'), kantor_id=kantor_id)
         db.session.add(new_user)
+        db.session.flush()
+        record_sync_changes('user', [new_user.id], new_user.kantor_id)
         db.session.commit()
         flash(f'User "{username}" berhasil ditambahkan.', 'success')
         return redirect(url_for('manage_users'))
@@ -331,38 +2609,79 @@ def add_user():
 @app.route('/admin/users/delete/<int:user_id>', methods=['POST'])
 @login_required
 @admin_required
+@central_only
 def delete_user(user_id):
     if user_id == session['user_id']:
         flash('Kamu tidak bisa menghapus akunmu sendiri!', 'danger')
         return redirect(url_for('manage_users'))
     user = User.query.get_or_404(user_id)
-    if user.transactions:
+    if user.transactions or archived_ids('user_id', [user.id]):
         flash(f'User "{user.username}" tidak bisa dihapus karena memiliki riwayat transaksi.', 'danger')
         return redirect(url_for('manage_users'))
+    record_sync_changes('user', [user.id], user.kantor_id)
+    ApiToken.query.filter_by(user_id=user.id).delete()
     db.session.delete(user)
     db.session.commit()
+    _permission_cache.pop(user_id)
     flash(f'User "{user.username}" telah dihapus.', 'success')
     return redirect(url_for('manage_users'))
 
 @app.route('/admin/users/permissions/<int:user_id>', methods=['GET', 'POST'])
 @login_required
 @admin_required
+@central_only
 def assign_permissions(user_id):
     user_to_edit = User.query.get_or_404(user_id)
     materials_in_office = Material.query.filter_by(kantor_id=user_to_edit.kantor_id).order_by(Material.nama_material).all()
+    permissions = user_material_permissions.c
+    current_ids = {material_id for (material_id,) in db.session.query(permissions.material_id).filter(permissions.user_id == user_id)}
     if request.method == 'POST':
-        permitted_ids = request.form.getlist('material_ids')
-        user_to_edit.permitted_materials.clear()
-        for mat_id in permitted_ids:
-            material = Material.query.get(mat_id)
-            if material:
-                user_to_edit.permitted_materials.append(material)
+        office_ids = {material.id for material in materials_in_office}
+        requested_ids = {int(mat_id) for mat_id in request.form.getlist('material_ids') if mat_id.isdigit()} & office_ids
+        removed_ids, added_ids = current_ids - requested_ids, requested_ids - current_ids
+        if removed_ids:
+            db.session.execute(user_material_permissions.delete().where(permissions.user_id == user_id, permissions.material_id.in_(removed_ids)))
+        if added_ids:
+            db.session.execute(user_material_permissions.insert(), [{'user_id': user_id, 'material_id': material_id} for material_id in added_ids])
+        if removed_ids or added_ids:
+            User.query.filter_by(id=user_id).update({'izin_versi': User.izin_versi + 1}, synchronize_session=False)
+            record_sync_changes('permissions', [user_id], user_to_edit.kantor_id)
         db.session.commit()
+        _permission_cache.pop(user_id)
         flash(f'Izin material untuk user "{user_to_edit.username}" telah diperbarui.', 'success')
         return redirect(url_for('manage_users'))
-    current_permissions = [mat.id for mat in user_to_edit.permitted_materials]
+    current_permissions = list(current_ids)
     return render_template('admin_user_permissions.html', user=user_to_edit, materials=materials_in_office, current_permissions=current_permissions)
 
+@app.route('/admin/metrics')
+@login_required
+@admin_required
+def admin_metrics():
+    return render_template('admin_metrics.html', metrics=metrics_summary(), slow_request_ms=app.config['SLOW_REQUEST_MS'], slow_query_ms=app.config['SLOW_QUERY_MS'])
+
+@app.route('/metrics')
+def prometheus_metrics():
+    token = app.config['METRICS_TOKEN']
+    if session.get('role') != 'admin' and not (token and request.headers.get('Authorization') == f'Bearer {token}'):
+        abort(403)
+    lines = [
+        '# HELP minty_request_duration_seconds Latensi request per endpoint.',
+        '# TYPE minty_request_duration_seconds summary',
+    ]
+    summary = metrics_summary()
+    for item in summary:
+        label = f'endpoint="{item["endpoint"]}"'
+        lines += [f'minty_request_duration_seconds{{{label},quantile="0.5"}} {item["p50"]:.6f}',
+                  f'minty_request_duration_seconds{{{label},quantile="0.95"}} {item["p95"]:.6f}',
+                  f'minty_request_duration_seconds_sum{{{label}}} {item["total_time"]:.6f}',
+                  f'minty_request_duration_seconds_count{{{label}}} {item["count"]}']
+    for name, key, help_text in (('minty_request_errors_total', 'errors', 'Jumlah response 5xx per endpoint.'),
+                                 ('minty_sql_queries_total', 'queries', 'Jumlah statement SQL per endpoint.'),
+                                 ('minty_sql_duration_seconds_total', 'db_time', 'Total waktu SQL per endpoint.')):
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+        lines += [f'{name}{{endpoint="{item["endpoint"]}"}} {item[key]}' for item in summary]
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
 @app.route('/admin/offices')
 @login_required
 @admin_required
@@ -373,6 +2692,7 @@ def manage_offices():
 @app.route('/admin/offices/add', methods=['GET', 'POST'])
 @login_required
 @admin_required
+@central_only
 def add_office():
     if request.method == 'POST':
         nama = request.form.get('nama_kantor')
@@ -382,6 +2702,8 @@ def add_office():
             return redirect(url_for('add_office'))
         new_office = Kantor(nama_kantor=nama, kode_kantor=kode)
         db.session.add(new_office)
+        db.session.flush()
+        record_sync_changes('kantor', [new_office.id], new_office.id)
         db.session.commit()
         flash('Kantor baru berhasil ditambahkan!', 'success')
         return redirect(url_for('manage_offices'))
@@ -390,12 +2712,16 @@ def add_office():
 @app.route('/admin/offices/edit/<int:office_id>', methods=['GET', 'POST'])
 @login_required
 @admin_required
+@central_only
 def edit_office(office_id):
     office = Kantor.query.get_or_404(office_id)
     if request.method == 'POST':
         office.nama_kantor = request.form.get('nama_kantor')
         office.kode_kantor = request.form.get('kode_kantor')
+        office.low_stock_threshold = request.form.get('low_stock_threshold', office.low_stock_threshold, type=int)
+        record_sync_changes('kantor', [office.id], office.id)
         db.session.commit()
+        _dashboard_cache.pop(office.id)
         flash('Data kantor berhasil diperbarui.', 'success')
         return redirect(url_for('manage_offices'))
     return render_template('edit_office.html', office=office)
@@ -403,9 +2729,10 @@ def edit_office(office_id):
 @app.route('/admin/offices/delete/<int:office_id>', methods=['POST'])
 @login_required
 @admin_required
+@central_only
 def delete_office(office_id):
     office = Kantor.query.get_or_404(office_id)
-    if office.users or office.materials or office.transactions:
+    if office.users or office.materials or office.transactions or ArchiveSegment.query.filter_by(kantor_id=office.id).first():
         flash(f'Gagal! Kantor "{office.nama_kantor}" tidak bisa dihapus karena masih memiliki data terkait.', 'danger')
         return redirect(url_for('manage_offices'))
     db.session.delete(office)
@@ -0,0 +1,238 @@
+# Benchmark & load test untuk rute-rute utama.
+#
+#   python bench.py                                  # SQLite sementara, data sintetis default
+#   python bench.py --database-url postgresql://...  # Postgres lokal (data bench dipakai ulang bila sudah ada)
+#   python bench.py --update-baseline                # simpan hasil sebagai baseline
+#
+# Hasil dibandingkan dengan baseline (bench_baseline.json); exit code 1 bila p95 sebuah skenario
+# lebih lambat dari baseline * (1 + toleransi).
+import argparse
+import io
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+WORDS = ['Semen', 'Besi', 'Pipa', 'Kabel', 'Cat', 'Baut', 'Mur', 'Paku', 'Kawat', 'Triplek', 'Keramik', 'Genteng',
+         'Pasir', 'Batu', 'Kayu', 'Lem', 'Engsel', 'Kunci', 'Lampu', 'Saklar']
+VARIANTS = ['Putih', 'Hitam', 'Galvanis', 'Beton', 'PVC', 'Tembaga', 'Jati', 'Super', 'Ekonomi', 'Premium']
+SATUAN = ['pcs', 'kg', 'm', 'sak', 'lbr']
+INSERT_BATCH = 5000
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark rute utama mintyapp dengan data sintetis multi-kantor.')
+    parser.add_argument('--database-url', help='Default: file SQLite sementara.')
+    parser.add_argument('--offices', type=int, default=3)
+    parser.add_argument('--users', type=int, default=10, help='User per kantor.')
+    parser.add_argument('--materials', type=int, default=2000, help='Material per kantor.')
+    parser.add_argument('--transactions', type=int, default=100000, help='Transaksi per kantor.')
+    parser.add_argument('--iterations', type=int, default=30)
+    parser.add_argument('--lines', type=int, default=50, help='Jumlah baris per new_transaction.')
+    parser.add_argument('--import-rows', type=int, default=20000)
+    parser.add_argument('--import-iterations', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--baseline', default='bench_baseline.json')
+    parser.add_argument('--update-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    parser.add_argument('--output', help='Tulis hasil lengkap ke file JSON.')
+    return parser.parse_args()
+
+
+def _insert(minty, table, rows):
+    for start in range(0, len(rows), INSERT_BATCH):
+        minty.db.session.execute(table.insert(), rows[start:start + INSERT_BATCH])
+
+
+def seed(minty, args, rng):
+    from werkzeug.security import generate_password_hash
+    db = minty.db
+    if minty.Kantor.query.filter_by(kode_kantor='BENCH0').first():
+        print('Data benchmark sudah ada, seeding dilewati.')
+        return
+    started = time.perf_counter()
+    existing_satuan = {nama for (nama,) in db.session.query(minty.Satuan.nama)}
+    _insert(minty, minty.Satuan.__table__, [{'nama': nama} for nama in SATUAN if nama not in existing_satuan])
+    _insert(minty, minty.Kantor.__table__, [{'nama_kantor': f'Kantor Bench {k}', 'kode_kantor': f'BENCH{k}', 'low_stock_threshold': 50}
+                                            for k in range(args.offices)])
+    kantor_ids = [kantor.id for kantor in minty.Kantor.query.filter(minty.Kantor.kode_kantor.like('BENCH%')).order_by(minty.Kantor.id)]
+    satuan_ids = [satuan_id for (satuan_id,) in db.session.query(minty.Satuan.id)]
+    password = generate_password_hash('bench', method='pbkdf2:sha256')
+    now = datetime.now()
+    for k, kantor_id in enumerate(kantor_ids):
+        _insert(minty, minty.User.__table__,
+                [{'username': f'bench_admin_{k}', 'password': password, 'role': 'admin', 'kantor_id': kantor_id}] +
+                [{'username': f'bench_user_{k}_{j}', 'password': password, 'role': 'user', 'kantor_id': kantor_id} for j in range(args.users)])
+        _insert(minty, minty.Material.__table__, [
+            {'id_barang': f'BRG-{k}-{i:06d}', 'nama_material': f'{rng.choice(WORDS)} {rng.choice(VARIANTS)} {i}',
+             'jumlah': rng.randint(0, 500), 'kantor_id': kantor_id, 'satuan_id': rng.choice(satuan_ids)}
+            for i in range(args.materials)])
+        user_ids = [user_id for (user_id,) in db.session.query(minty.User.id).filter_by(kantor_id=kantor_id)]
+        material_ids = [material_id for (material_id,) in db.session.query(minty.Material.id).filter_by(kantor_id=kantor_id)]
+        _insert(minty, minty.Transaction.__table__, [
+            {'material_id': rng.choice(material_ids), 'tipe_transaksi': rng.choice(['IN', 'OUT']), 'jumlah': rng.randint(1, 20),
+             'sumber': 'bench', 'user_id': rng.choice(user_ids), 'kantor_id': kantor_id,
+             'timestamp': now - timedelta(seconds=rng.randint(0, 365 * 24 * 3600))}
+            for _ in range(args.transactions)])
+        _insert(minty, minty.user_material_permissions, [
+            {'user_id': user_id, 'material_id': material_id}
+            for user_id in user_ids for material_id in rng.sample(material_ids, max(len(material_ids) // 3, 1))])
+        db.session.commit()
+    print(f'Seeding selesai dalam {time.perf_counter() - started:.1f} detik.')
+
+
+def build_import_workbook(rows, k, materials, rng):
+    from openpyxl import Workbook
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('Import')
+    sheet.append(['ID Barang', 'Nama Material', 'Jumlah', 'Satuan'])
+    for i in range(rows):
+        # Separuh baris menambah stok material lama, separuh membuat material baru.
+        id_barang = f'BRG-{k}-{rng.randrange(materials):06d}' if i % 2 else f'IMP-{k}-{rng.randrange(10 ** 9):09d}'
+        sheet.append([id_barang, f'{rng.choice(WORDS)} Impor {i}', rng.randint(1, 100), rng.choice(SATUAN)])
+    output = io.BytesIO()
+    workbook.save(output)
+    return output.getvalue()
+
+
+def _client(minty, user):
+    client = minty.app.test_client()
+    with client.session_transaction() as session:
+        session.update(user_id=user.id, username=user.username, role=user.role, kantor_id=user.kantor_id, nama_kantor=user.kantor.nama_kantor)
+    return client
+
+
+def _wait_for_job(minty, job_id, timeout=600):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        minty.db.session.expire_all()
+        job = minty.db.session.get(minty.Job, job_id)
+        if job.status in ('done', 'failed'):
+            return job.status == 'done'
+        time.sleep(0.05)
+    return False
+
+
+def run_scenarios(minty, args, rng):
+    admin = minty.User.query.filter_by(username='bench_admin_0').one()
+    kantor_id = admin.kantor_id
+    admin_client = _client(minty, admin)
+    user = minty.User.query.filter(minty.User.username.like('bench_user_0_%')).first()
+    material_ids = [material_id for (material_id,) in minty.db.session.query(minty.Material.id).filter_by(kantor_id=kantor_id)]
+    start_date = (datetime.now() - timedelta(days=30)).strftime('%Y-%m-%d')
+
+    def new_transaction():
+        lines = rng.sample(material_ids, min(args.lines, len(material_ids)))
+        return admin_client.post('/transaction/new', data={'tipe_transaksi': 'IN', 'sumber_in': 'bench', 'material_id': [str(i) for i in lines],
+                                                           'jumlah': [str(rng.randint(1, 10)) for _ in lines]})
+
+    def assign_permissions():
+        chosen = rng.sample(material_ids, len(material_ids) // 3)
+        return admin_client.post(f'/admin/users/permissions/{user.id}', data={'material_ids': [str(i) for i in chosen]})
+
+    scenarios = [
+        ('dashboard', args.iterations, lambda: admin_client.get('/dashboard')),
+        ('dashboard_search', args.iterations, lambda: admin_client.get(f'/dashboard?search={rng.choice(WORDS).lower()}')),
+        ('history', args.iterations, lambda: admin_client.get('/history')),
+        ('history_filtered', args.iterations, lambda: admin_client.get(f'/history?tipe_transaksi=OUT&start={start_date}')),
+        ('new_transaction', args.iterations, new_transaction),
+        ('assign_permissions', args.iterations, assign_permissions),
+    ]
+    results = {}
+    for name, iterations, request in scenarios:
+        results[name] = _measure(name, iterations, request)
+
+    workbook = build_import_workbook(args.import_rows, 0, args.materials, rng)
+    durations, failures = [], 0
+    for _ in range(args.import_iterations):
+        started = time.perf_counter()
+        response = admin_client.post('/admin/materials/import', data={'excel_file': (io.BytesIO(workbook), 'bench.xlsx')},
+                                     content_type='multipart/form-data')
+        job_id = response.headers.get('Location', '').partition('job_id=')[2]
+        if response.status_code >= 400 or not job_id or not _wait_for_job(minty, job_id):
+            failures += 1
+        durations.append(time.perf_counter() - started)
+    results['import_materials'] = _summarize(durations, failures)
+    return results
+
+
+def _measure(name, iterations, request):
+    durations, failures = [], 0
+    request()  # warm-up: cache, koneksi pool, kompilasi template
+    for _ in range(iterations):
+        started = time.perf_counter()
+        response = request()
+        durations.append(time.perf_counter() - started)
+        if response.status_code >= 400:
+            failures += 1
+    return _summarize(durations, failures)
+
+
+def _percentile(values, percent):
+    values = sorted(values)
+    return values[max(math.ceil(percent / 100 * len(values)) - 1, 0)] if values else 0.0
+
+
+def _summarize(durations, failures):
+    total = sum(durations)
+    return {'n': len(durations), 'failures': failures, 'throughput': len(durations) / total if total else 0.0,
+            'p50_ms': _percentile(durations, 50) * 1000, 'p95_ms': _percentile(durations, 95) * 1000,
+            'max_ms': max(durations, default=0.0) * 1000}
+
+
+def print_report(results):
+    print(f"{'skenario':<20}{'n':>5}{'gagal':>7}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}")
+    for name, result in results.items():
+        print(f"{name:<20}{result['n']:>5}{result['failures']:>7}{result['throughput']:>10.1f}"
+              f"{result['p50_ms']:>10.1f}{result['p95_ms']:>10.1f}{result['max_ms']:>10.1f}")
+
+
+def find_regressions(results, baseline, tolerance):
+    regressions = []
+    for name, result in results.items():
+        if result['failures']:
+            regressions.append(f'{name}: {result["failures"]} request gagal')
+        reference = baseline.get(name)
+        # Selisih absolut < 2 ms diabaikan supaya skenario yang sangat cepat tidak flaky.
+        if reference and result['p95_ms'] > reference['p95_ms'] * (1 + tolerance) and result['p95_ms'] - reference['p95_ms'] > 2:
+            regressions.append(f"{name}: p95 {result['p95_ms']:.1f} ms > baseline {reference['p95_ms']:.1f} ms (+{tolerance:.0%})")
+    return regressions
+
+
+def main():
+    args = parse_args()
+    rng = random.Random(args.seed)
+    workdir = tempfile.mkdtemp(prefix='minty-bench-')
+    os.environ['DATABASE_URL'] = args.database_url or 'sqlite:///' + os.path.join(workdir, 'bench.db')
+    os.environ.setdefault('JOB_UPLOAD_DIR', os.path.join(workdir, 'uploads'))
+    import app as minty
+    minty.app.config['TESTING'] = True
+    minty.upgrade_schema()
+    with minty.app.app_context():
+        seed(minty, args, rng)
+        results = run_scenarios(minty, args, rng)
+    print_report(results)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+    if args.update_baseline:
+        with open(args.baseline, 'w') as output:
+            json.dump(results, output, indent=2)
+        print(f'Baseline disimpan ke {args.baseline}.')
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f'Baseline {args.baseline} belum ada; jalankan dengan --update-baseline.')
+        return 0
+    with open(args.baseline) as source:
+        regressions = find_regressions(results, json.load(source), args.tolerance)
+    for regression in regressions:
+        print(f'REGRESI {regression}')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
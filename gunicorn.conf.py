@@ -0,0 +1,47 @@
+# Konfigurasi gunicorn untuk deployment server (Postgres lewat DATABASE_URL):
+#   gunicorn -c gunicorn.conf.py app:app
+# Total koneksi DB maksimum = workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW); dengan default
+# (maks. 8 worker, pool threads + 2, overflow 2) = 64, di bawah max_connections Postgres 100.
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('GUNICORN_WORKERS', min(multiprocessing.cpu_count() + 1, 8)))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 60))
+# Job latar belakang berjalan di dalam worker, jadi daur ulang worker (max_requests) nonaktif
+# secara default; bila diaktifkan, job yang sedang berjalan ditandai gagal saat worker berhenti.
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 0))
+max_requests_jitter = 200 if max_requests else 0
+# Metrik per worker dikumpulkan di satu direktori agar /metrics menjumlahkan semua worker.
+os.environ.setdefault('METRICS_DIR', os.path.join(tempfile.gettempdir(), f'mintyapp-metrics-{os.getpid()}'))
+
+def on_starting(server):
+    shutil.rmtree(os.environ['METRICS_DIR'], ignore_errors=True)
+    os.makedirs(os.environ['METRICS_DIR'])
+    import app
+    app.upgrade_schema()
+    app.mark_startup('init_db')
+    app.recover_jobs(resume_queued=False)
+    # Koneksi pool master tidak boleh ikut ter-fork ke worker.
+    app.db.engine.dispose()
+
+def post_worker_init(worker):
+    import app
+    app.recover_jobs(fail_running=False)
+    # Setiap worker punya scheduler snapshot/rollup/arsip; advisory lock Postgres memilih satu per putaran.
+    app.start_snapshot_scheduler()
+    # /health baru 200 setelah skema siap dan worker ini selesai inisialisasi.
+    app.mark_ready()
+
+def worker_exit(server, worker):
+    import app
+    app.abandon_running_jobs()
+    # Counter worker yang berhenti tetap ikut dijumlahkan agar total tidak mundur.
+    app.flush_metrics(retire=True)
+
+def on_exit(server):
+    shutil.rmtree(os.environ['METRICS_DIR'], ignore_errors=True)
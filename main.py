@@ -1,28 +1,81 @@
+import time
+STARTED_AT = time.perf_counter()
+
 import webview
 import app as flask_app
 import threading
 import sys
 import os
-import time
+import json
+import urllib.request
+import urllib.error
+
+HOST = '127.0.0.1'
+PORT = 5000
+READY_TIMEOUT = 60
 
 def run_flask():
-    flask_app.app.run(host='127.0.0.1', port=5000)
+    try:
+        from waitress import serve
+    except ImportError:
+        flask_app.app.run(host=HOST, port=PORT, threaded=True)
+        return
+    serve(flask_app.app, host=HOST, port=PORT, threads=int(os.environ.get('WAITRESS_THREADS', 8)))
+
+def wait_until_ready(timeout=READY_TIMEOUT):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(f'http://{HOST}:{PORT}/health', timeout=1) as response:
+                if response.status == 200:
+                    return True
+        except (urllib.error.URLError, OSError):
+            pass
+        time.sleep(0.05)
+    return False
+
+def write_startup_report():
+    report = flask_app.startup_report()
+    flask_app.app.logger.info('Startup timing (detik): %s', report)
+    try:
+        with open(os.path.join(flask_app.basedir, 'startup_timing.log'), 'a') as log:
+            log.write(json.dumps({'frozen': getattr(sys, 'frozen', False), 'marks': report}) + '\n')
+    except OSError:
+        pass
+
+def on_main_window_loaded():
+    flask_app.mark_startup('window_loaded')
+    write_startup_report()
 
 def load_main_window():
-    time.sleep(3)
+    # Splash sudah tampil; inisialisasi database berjalan di sini, lalu jendela utama dibuka
+    # begitu /health menjawab 200, bukan setelah jeda tetap.
+    flask_app.mark_startup('splash_shown')
+    flask_app.init_db()
+    flask_app.upgrade_schema()
+    flask_app.recover_jobs()
+    flask_app.start_snapshot_scheduler()
+    flask_app.start_sync_worker()
+    flask_app.mark_startup('init_db')
+    flask_app.mark_ready()
+    if not wait_until_ready():
+        flask_app.app.logger.error('Server tidak siap dalam %s detik.', READY_TIMEOUT)
+    flask_app.mark_startup('server_ready')
     if splash_window:
         splash_window.destroy()
-    webview.create_window(
+    main_window = webview.create_window(
         'Minty Project APP',
-        'http://127.0.0.1:5000',
+        f'http://{HOST}:{PORT}',
         width=1280,
         height=720,
         resizable=True,
         min_size=(1024, 600)
     )
+    main_window.events.loaded += on_main_window_loaded
 
 if __name__ == '__main__':
-    flask_app.init_db()
+    flask_app.mark_startup('process_start', at=STARTED_AT)
+    flask_app.mark_startup('imports')
     flask_thread = threading.Thread(target=run_flask, daemon=True)
     flask_thread.start()
 